@@ -1,6 +1,8 @@
 from django.contrib import admin
-from models import WikiPage, SchemaDataIndex, WikiPageRevision
+from models import WikiPage, SchemaDataIndex, WikiPageRevision, WikiPageLink, LinkJob
 
 admin.site.register(WikiPage)
 admin.site.register(SchemaDataIndex)
-admin.site.register(WikiPageRevision)
\ No newline at end of file
+admin.site.register(WikiPageRevision)
+admin.site.register(WikiPageLink)
+admin.site.register(LinkJob)
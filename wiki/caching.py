@@ -1,12 +1,14 @@
+import time
 import urllib
 from django.core.cache import cache
 
 
 def _set_cache(key, value, exp_sec=None):
+    args = [] if exp_sec is None else [exp_sec]
     if type(key) is str or type(key) is unicode:
-        cache.set(urllib.quote(key.encode('utf8')), value)
+        cache.set(urllib.quote(key.encode('utf8')), value, *args)
     else:
-        cache.set(key, value)
+        cache.set(key, value, *args)
 
 
 def _get_cache(key):
@@ -23,74 +25,135 @@ def _del_cache(key):
         cache.delete(key)
 
 
-max_recent_users = 20
+def _quote_key(key):
+    if type(key) is str or type(key) is unicode:
+        return urllib.quote(key.encode('utf8'))
+    else:
+        return key
 
 
-def add_recent_email(email):
-    emails = get_recent_emails()
-    if len(emails) > 0 and emails[-1] == email:
-        return
-    if email in emails:
-        emails.remove(email)
-    emails.append(email)
-    value = emails[-max_recent_users:]
-    _set_cache('view:recentemails', value)
+def _get_cache_many(keys):
+    quoted = dict((_quote_key(key), key) for key in keys)
+    values = cache.get_many(quoted.keys())
+    return dict((quoted[key], value) for key, value in values.items())
+
+
+def _set_cache_many(data):
+    if data:
+        cache.set_many(dict((_quote_key(key), value) for key, value in data.items()))
+
+
+def _del_cache_many(keys):
+    if keys:
+        cache.delete_many([_quote_key(key) for key in keys])
+
+
+def _generation(namespace):
+    """Return current generation of namespace. It's a part of every key in the namespace"""
+    key = 'generation:%s' % namespace
+    value = cache.get(key)
+    if value is None:
+        # start from current time so that keys of an evicted generation are never reused
+        value = int(time.time() * 1000000)
+        if not cache.add(key, value, None):
+            value = cache.get(key, value)
+    return value
 
 
-def get_recent_emails():
-    key = 'view:recentemails'
+def _bump_generation(namespace):
+    """Invalidate every key in namespace at once"""
+    key = 'generation:%s' % namespace
     try:
-        emails = _get_cache(key)
-        if emails is None:
-            cache.clear()
-            emails = []
-        return emails
-    except:
-        return []
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000000), None)
+
+
+def _ns_key(namespace, key=None):
+    if key is None:
+        return namespace
+    return '%s:%s' % (namespace, key)
+
+
+def _get_ns_cache(namespace, key=None):
+    """Values are stored with the generation of their namespace. The generation and the value are
+    read at once, and a value of an older generation is a miss"""
+    generation_key = 'generation:%s' % namespace
+    value_key = _quote_key(_ns_key(namespace, key))
+    values = cache.get_many([generation_key, value_key])
+    if generation_key not in values or value_key not in values:
+        return None
+
+    generation, value = values[value_key]
+    return value if generation == values[generation_key] else None
+
+
+def _set_ns_cache(namespace, key, value, exp_sec=None):
+    _set_cache(_ns_key(namespace, key), (_generation(namespace), value), exp_sec)
+
+
+def _get_ns_cache_many(namespace, keys):
+    """Returns {key: value} of keys which have values of the current generation, read at once"""
+    generation_key = 'generation:%s' % namespace
+    value_keys = dict((_quote_key(_ns_key(namespace, key)), key) for key in keys)
+    values = cache.get_many([generation_key] + value_keys.keys())
+    if generation_key not in values:
+        return {}
+
+    result = {}
+    for value_key, key in value_keys.items():
+        if value_key in values and values[value_key][0] == values[generation_key]:
+            result[key] = values[value_key][1]
+    return result
+
+
+def _set_ns_cache_many(namespace, data):
+    generation = _generation(namespace)
+    _set_cache_many(dict((_ns_key(namespace, key), (generation, value)) for key, value in data.items()))
 
 
 def get_schema_set():
-    return _get_cache('schema_set')
+    return _get_ns_cache('schema', 'schema_set')
 
 
 def set_schema_set(value):
-    _set_cache('schema_set', value)
+    _set_ns_cache('schema', 'schema_set', value)
 
 
 def get_schema(key):
-    return _get_cache('schema:%s' % key)
+    return _get_ns_cache('schema', key)
 
 
 def set_schema(key, value):
-    _set_cache('schema:%s' % key, value)
+    _set_ns_cache('schema', key, value)
 
 
 def get_schema_itemtypes():
-    return _get_cache('schema:itemtypes')
+    return _get_ns_cache('schema', 'itemtypes')
 
 
 def set_schema_itemtypes(value):
-    _set_cache('schema:itemtypes', value)
+    _set_ns_cache('schema', 'itemtypes', value)
 
 
 def get_schema_datatype(type_name):
-    return _get_cache('schema:datatype:%s' % type_name)
+    return _get_ns_cache('schema', 'datatype:%s' % type_name)
 
 
 def set_schema_datatype(type_name, prop):
-    _set_cache('schema:datatype:%s' % type_name, prop)
+    _set_ns_cache('schema', 'datatype:%s' % type_name, prop)
 
 
 def get_schema_property(prop_name):
-    return _get_cache('schema:prop:%s' % prop_name)
+    return _get_ns_cache('schema', 'prop:%s' % prop_name)
 
 
 def set_schema_property(prop_name, prop):
-    _set_cache('schema:prop:%s' % prop_name, prop)
+    _set_ns_cache('schema', 'prop:%s' % prop_name, prop)
 
 
 def get_hashbangs(title):
-    _get_cache('model:hashbangs:%s' % title)
+    return _get_cache('model:hashbangs:%s' % title)
 
 
 def set_hashbangs(title, value):
@@ -107,6 +170,16 @@ def set_rendered_body(title, value):
     _set_cache('model:rendered_body:%s' % title, value)
 
 
+def get_rendered_blocks(keys):
+    values = _get_cache_many(['model:rendered_block:%s' % key for key in keys])
+    return dict((key, values['model:rendered_block:%s' % key]) for key in keys
+                if 'model:rendered_block:%s' % key in values)
+
+
+def set_rendered_blocks(data):
+    _set_cache_many(dict(('model:rendered_block:%s' % key, value) for key, value in data.items()))
+
+
 def get_data(title):
     return _get_cache('model:data:%s' % title)
 
@@ -139,82 +212,96 @@ def del_hashbangs(title):
     _del_cache('model:hashbangs:%s' % title)
 
 
+def set_rendered(title, rendered_body, hashbangs):
+    _set_cache_many({
+        'model:rendered_body:%s' % title: rendered_body,
+        'model:hashbangs:%s' % title: hashbangs,
+    })
+
+
+def del_rendered(titles):
+    """Delete rendered bodies and hashbangs of all titles at once"""
+    keys = []
+    for title in titles:
+        keys.append('model:rendered_body:%s' % title)
+        keys.append('model:hashbangs:%s' % title)
+    _del_cache_many(keys)
+
+
 def set_titles(email, content):
     try:
-        add_recent_email(email)
-        _set_cache('model:titles:%s' % email, content)
+        _set_ns_cache('model:titles', email, content)
     except:
         pass
 
 
 def get_titles(email):
     try:
-        return _get_cache('model:titles:%s' % email)
+        return _get_ns_cache('model:titles', email)
     except:
         pass
 
 
 def del_titles():
     try:
-        emails = get_recent_emails()
-        for email in emails + ['None']:
-            cache.delete('model:titles:%s' % email)
+        _bump_generation('model:titles')
     except:
         pass
 
 
 def set_schema_selectable_itemtypes(value):
-    _set_cache('schema:selectable_itemtypes', value)
+    _set_ns_cache('schema', 'selectable_itemtypes', value)
 
 
 def get_schema_selectable_itemtypes():
-    return _get_cache('schema:selectable_itemtypes')
+    return _get_ns_cache('schema', 'selectable_itemtypes')
 
 
 def set_cardinalities(key, data):
     try:
-        return _set_cache('schema:cardinalities:%s' % key, data)
+        return _set_ns_cache('schema', 'cardinalities:%s' % key, data)
     except:
         pass
 
 
 def get_cardinalities(key):
     try:
-        return _get_cache('schema:cardinalities:%s' % key)
+        return _get_ns_cache('schema', 'cardinalities:%s' % key)
     except:
         pass
 
 
 def get_config():
-    return _get_cache('model:config')
+    return _get_ns_cache('model:config')
 
 
 def set_config(value):
-    _set_cache('model:config', value)
+    _set_ns_cache('model:config', None, value)
 
 
 def del_config():
-    cache.delete('model:config')
+    _bump_generation('model:config')
+
+
+def del_schema():
+    _bump_generation('schema')
+
+
+def get_schema_generation():
+    return _generation('schema')
+
 
+def get_redirects(titles):
+    """Returns {title: final target} of titles, where title itself is the target of a page without redirection"""
+    return _get_ns_cache_many('model:redirects', titles)
 
-def set_wikiquery(q, email, value):
-    # adaptive expiration time
-    exp_sec = 60
-    if type(value) == list:
-        if len(value) < 2:
-            exp_sec = 60
-        elif len(value) < 10:
-            exp_sec = 60 * 5
-        elif len(value) < 100:
-            exp_sec = 60 * 60
-        elif len(value) < 500:
-            exp_sec = 60 * 60 * 24
 
-    _set_cache('model:wikiquery:%s:%s' % (urllib.quote(q), email), value, exp_sec)
+def set_redirects(data):
+    _set_ns_cache_many('model:redirects', data)
 
 
-def get_wikiquery(q, email):
-    return _get_cache('model:wikiquery:%s:%s' % (urllib.quote(q), email))
+def del_redirects():
+    _bump_generation('model:redirects')
 
 
 def flush_all():
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Binary edge list of the link graph.
+
+Layout (little endian):
+    header: magic, version, number of titles, number of rels, number of edges, offset of string tables
+    edges: (source id, target id, rel id, public) records of fixed size
+    string tables: titles then rels, each as 2 byte length and utf-8 bytes
+
+Edges come first so that they can be streamed without knowing all titles in advance.
+Edge records have a fixed size, so a memory-mapped file can be read at any position.
+"""
+import mmap
+import struct
+
+
+MAGIC = 'EWLG'
+VERSION = 1
+HEADER = struct.Struct('<4sHIIIQ')
+EDGE = struct.Struct('<IIHB')
+LENGTH = struct.Struct('<H')
+
+
+def write(f, links):
+    """Write (source, target, rel, public) tuples to seekable file f. Returns number of edges"""
+    titles = {}
+    rels = {}
+    count = 0
+
+    f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+    for source, target, rel, public in links:
+        f.write(EDGE.pack(_intern(titles, source), _intern(titles, target), _intern(rels, rel), 1 if public else 0))
+        count += 1
+
+    offset = f.tell()
+    for table in [titles, rels]:
+        for value in sorted(table, key=table.get):
+            encoded = value.encode('utf-8')
+            f.write(LENGTH.pack(len(encoded)))
+            f.write(encoded)
+
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, len(titles), len(rels), count, offset))
+    f.seek(0, 2)
+    return count
+
+
+def _intern(table, value):
+    if value not in table:
+        table[value] = len(table)
+    return table[value]
+
+
+class GraphFile(object):
+    """Memory-mapped edge list written by write()"""
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, title_count, rel_count, self.edge_count, offset = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('Not a link graph file: %s' % path)
+
+        self.titles, offset = self._read_strings(offset, title_count)
+        self.rels, _ = self._read_strings(offset, rel_count)
+
+    def __len__(self):
+        return self.edge_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def edge(self, index):
+        """Returns (source id, target id, rel id, public) of index-th edge"""
+        source, target, rel, public = EDGE.unpack_from(self._map, HEADER.size + index * EDGE.size)
+        return source, target, rel, public == 1
+
+    def edge_ids(self):
+        for index in xrange(self.edge_count):
+            yield self.edge(index)
+
+    def edges(self):
+        """Yields (source, target, rel, public) tuples with titles"""
+        for source, target, rel, public in self.edge_ids():
+            yield self.titles[source], self.titles[target], self.rels[rel], public
+
+    def _read_strings(self, offset, count):
+        values = []
+        for _ in xrange(count):
+            length, = LENGTH.unpack_from(self._map, offset)
+            offset += LENGTH.size
+            values.append(self._map[offset:offset + length].decode('utf-8'))
+            offset += length
+        return values, offset
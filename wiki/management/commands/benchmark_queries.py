@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import random
+import timeit
+from datetime import datetime, timedelta
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.utils.timezone import utc
+from wiki.models import WikiPage, SchemaDataIndex, WikiqueryPlan
+
+
+class Command(NoArgsCommand):
+    help = 'Measure hot lookups of wiki pages. Use --populate on a scratch database only'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--populate', type='int', default=0,
+                    help='Insert given number of synthetic pages before measuring'),
+        make_option('--repeat', type='int', default=200,
+                    help='Number of queries to run for each lookup'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['populate']:
+            self.populate(options['populate'])
+
+        count = WikiPage.objects.count()
+        if count == 0:
+            self.stdout.write('No pages. Run with --populate on a scratch database.')
+            return
+        titles = list(WikiPage.objects.values_list('title', flat=True)[:10000])
+        repeat = options['repeat']
+
+        def lookups():
+            yield 'get_by_title', lambda: WikiPage.get_by_title(random.choice(titles))
+            yield 'get_changes', lambda: list(WikiPage.get_changes(None, random.randint(0, 10)))
+            yield 'get_posts_of', lambda: list(WikiPage.get_posts_of(u'Blog', random.randint(0, 10)))
+            yield 'query_titles', lambda: SchemaDataIndex.query_titles(u'author', u'Author %d' % random.randint(0, 999))
+            yield 'has_match', lambda: SchemaDataIndex.has_match(random.choice(titles), u'author', u'Author 1')
+            yield 'wikiquery', lambda: WikiqueryPlan.get(
+                u'schema:"Book" * (author:"Author %d" + author:"Author 1")' % random.randint(0, 999)).titles()
+
+        self.stdout.write('%d pages, %d queries each' % (count, repeat))
+        for name, func in lookups():
+            elapsed = timeit.timeit(func, number=repeat)
+            self.stdout.write('%-14s %8.3f ms' % (name, elapsed * 1000 / repeat))
+
+    def populate(self, count):
+        now = datetime.utcnow().replace(tzinfo=utc)
+        start = WikiPage.objects.count()
+
+        with transaction.atomic():
+            for offset in range(start, start + count, 1000):
+                pages = []
+                indexes = []
+                for i in range(offset, min(offset + 1000, start + count)):
+                    title = u'Page %d' % i
+                    published = i % 10 == 0
+                    pages.append(WikiPage(
+                        title=title, body=u'.schema Book\n[[author::Author %d]]' % (i % 1000),
+                        itemtype_path=u'Thing/CreativeWork/Book/', revision=1,
+                        updated_at=now - timedelta(minutes=i),
+                        published_to=u'Blog' if published else None,
+                        published_at=now - timedelta(minutes=i) if published else None,
+                    ))
+                    indexes += [
+                        SchemaDataIndex(title=title, name=u'schema', value=u'Thing/CreativeWork/Book/'),
+                        SchemaDataIndex(title=title, name=u'author', value=u'Author %d' % (i % 1000)),
+                        SchemaDataIndex(title=title, name=u'name', value=title),
+                    ]
+                WikiPage.objects.bulk_create(pages)
+                SchemaDataIndex.objects.bulk_create(indexes, batch_size=300)
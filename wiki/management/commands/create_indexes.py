@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+from wiki.models import WikiPage, WikiPageRevision, SchemaDataIndex
+
+
+class Command(NoArgsCommand):
+    help = 'Create indexes of wiki tables which were created by syncdb of an older version'
+
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        statements = [
+            'CREATE UNIQUE INDEX %s ON %s (%s)' % (qn('wiki_wikipage_title_uniq'), qn(WikiPage._meta.db_table), qn('title')),
+        ]
+        for model in [WikiPage, WikiPageRevision, SchemaDataIndex]:
+            statements += connection.creation.sql_indexes_for_model(model, no_style())
+
+        for sql in statements:
+            try:
+                with transaction.atomic():
+                    connection.cursor().execute(sql)
+                self.stdout.write('Created: %s' % sql)
+            except DatabaseError as e:
+                # index already exists, or duplicated titles for the unique index
+                self.stdout.write('Skipped: %s (%s)' % (sql, e))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from wiki.models import WikiPage, WikiPageLink, LinkScoreTable, PageLinkStat, SchemaDataIndex, Title
+from wiki import graph_file
+
+
+class Command(BaseCommand):
+    args = '<export|import> <file>'
+    help = 'Export the link graph to a binary edge list file, or replace the link graph with the file'
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[0] not in ('export', 'import'):
+            raise CommandError('Usage: link_graph %s' % self.args)
+
+        command, path = args
+        if command == 'export':
+            self.export(path)
+        else:
+            self.load(path)
+
+    def export(self, path):
+        links = WikiPageLink.objects.order_by('id').values_list('source', 'target', 'rel', 'public')
+        with open(path, 'wb') as f:
+            count = graph_file.write(f, links.iterator())
+        self.stdout.write('Exported %d links to %s' % (count, path))
+
+    def load(self, path):
+        try:
+            graph = graph_file.GraphFile(path)
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        with graph:
+            with transaction.atomic():
+                WikiPageLink.objects.all().delete()
+                batch = []
+                for source, target, rel, public in graph.edges():
+                    batch.append(WikiPageLink(source=source, target=target, rel=rel, public=public))
+                    if len(batch) == SchemaDataIndex.batch_size:
+                        WikiPageLink.objects.bulk_create(batch)
+                        batch = []
+                WikiPageLink.objects.bulk_create(batch)
+                Title.ids_of(graph.titles)
+                LinkScoreTable.objects.all().delete()
+                PageLinkStat.rebuild()
+
+            for i in range(0, len(graph.titles), SchemaDataIndex.batch_size):
+                WikiPage._invalidate_rendered(graph.titles[i:i + SchemaDataIndex.batch_size])
+            self.stdout.write('Imported %d links of %d pages from %s' % (len(graph), len(graph.titles), path))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import json
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+from wiki.models import WikiPage, WikiPageLink, PageLinkStat, SchemaDataIndex, Title
+
+
+class Command(NoArgsCommand):
+    help = 'Move links stored in _outlinks column of an older version into WikiPageLink table'
+
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        table = qn(WikiPage._meta.db_table)
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute('SELECT %s, %s, %s FROM %s' % (qn('title'), qn('acl_read'), qn('_outlinks'), table))
+                rows = cursor.fetchall()
+        except DatabaseError as e:
+            self.stdout.write('No legacy links to migrate (%s)' % e)
+            return
+
+        links = []
+        for title, acl_read, outlinks in rows:
+            for rel, targets in json.loads(outlinks or '{}').items():
+                links += [WikiPageLink(source=title, target=target, rel=rel, public=not acl_read)
+                          for target in set(targets)]
+
+        with transaction.atomic():
+            WikiPageLink.objects.all().delete()
+            WikiPageLink.objects.bulk_create(links, batch_size=SchemaDataIndex.batch_size)
+            PageLinkStat.rebuild()
+            Title.ids_of(set(l.source for l in links).union(l.target for l in links))
+        self.stdout.write('Migrated %d links of %d pages' % (len(links), len(rows)))
+
+        dropped = True
+        for column in ['_inlinks', '_outlinks']:
+            sql = 'ALTER TABLE %s DROP COLUMN %s' % (table, qn(column))
+            try:
+                with transaction.atomic():
+                    connection.cursor().execute(sql)
+                self.stdout.write('Dropped: %s' % sql)
+            except DatabaseError as e:
+                self.stdout.write('Skipped: %s (%s)' % (sql, e))
+                dropped = False
+
+        # legacy columns are NOT NULL without a default, so inserting a page fails while they remain
+        if not dropped:
+            self.rebuild_table()
+
+    def rebuild_table(self):
+        """Recreate page table without legacy columns, for databases which cannot drop columns (sqlite before 3.35)"""
+        qn = connection.ops.quote_name
+        table = WikiPage._meta.db_table
+        new_table = '%s__new' % table
+        columns = ', '.join(qn(f.column) for f in WikiPage._meta.local_fields)
+        create, _ = connection.creation.sql_create_model(WikiPage, no_style())
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for sql in create:
+                cursor.execute(sql.replace(qn(table), qn(new_table), 1))
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (qn(new_table), columns, columns, qn(table)))
+            # indexes of the old table go away with it. references of other tables are kept by the name
+            cursor.execute('DROP TABLE %s' % qn(table))
+            cursor.execute('ALTER TABLE %s RENAME TO %s' % (qn(new_table), qn(table)))
+            for sql in connection.creation.sql_indexes_for_model(WikiPage, no_style()):
+                cursor.execute(sql)
+        self.stdout.write('Rebuilt %s without legacy columns' % table)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from wiki.models import LinkJob
+
+
+class Command(NoArgsCommand):
+    help = 'Update pages linked from edited pages. Used when ASYNC_LINK_PROPAGATION is on'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', default=100,
+                    help='Number of jobs to run in a batch'),
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep waiting for new jobs instead of exiting when the queue is empty'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds to wait when the queue is empty'),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            done = LinkJob.process(options['limit'])
+            if done:
+                self.stdout.write('Processed %d jobs' % done)
+            elif not options['loop']:
+                break
+            else:
+                time.sleep(options['interval'])
+
+        failed = LinkJob.objects.filter(attempts__gte=LinkJob.max_attempts).count()
+        if failed:
+            self.stdout.write('%d jobs failed %d times. See last_error of LinkJob' % (failed, LinkJob.max_attempts))
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import NoArgsCommand
+from wiki.models import PageRedirect
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild redirect map from .redirect metadata of pages'
+
+    def handle_noargs(self, **options):
+        circular = PageRedirect.rebuild()
+        self.stdout.write('%d redirects' % PageRedirect.objects.count())
+        for title in circular:
+            self.stdout.write('Skipped circular redirection: %s' % title)
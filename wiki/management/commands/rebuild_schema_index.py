@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction, DatabaseError
+from wiki.models import WikiPage, SchemaDataIndex
+from wiki import caching
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild schema data index of all pages. Adds the number column to a table of an older version. ' \
+           'Run create_indexes afterwards to index the column'
+
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        field = SchemaDataIndex._meta.get_field('number')
+        sql = 'ALTER TABLE %s ADD COLUMN %s %s NULL' % (qn(SchemaDataIndex._meta.db_table), qn(field.column),
+                                                        field.db_type(connection))
+        try:
+            with transaction.atomic():
+                connection.cursor().execute(sql)
+            self.stdout.write('Added: %s' % sql)
+        except DatabaseError as e:
+            # column already exists
+            self.stdout.write('Skipped: %s (%s)' % (sql, e))
+
+        # schema files may have been changed by an upgrade. index with them and make every process
+        # recompile its wikiquery plans
+        caching.del_schema()
+
+        titles = list(WikiPage.objects.values_list('title', flat=True))
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            for page in WikiPage.objects.filter(title__in=titles[i:i + SchemaDataIndex.batch_size]):
+                # datePageModified is not indexed when pages are updated
+                data = dict((k, v) for k, v in page.data.items() if k != 'datePageModified')
+                SchemaDataIndex.rebuild_index(page.title, data)
+        self.stdout.write('Rebuilt index of %d pages' % len(titles))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from wiki.models import WikiPage
+from wiki import related, graph_file
+
+
+class Command(NoArgsCommand):
+    help = 'Compute related links of all pages by personalized PageRank over the link graph'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--restart', type='float', default=0.15,
+                    help='Probability of jumping back to the page on each step'),
+        make_option('--iterations', type='int', default=20,
+                    help='Maximum number of power iterations for a page'),
+        make_option('--graph', default=None,
+                    help='Read links from a file written by link_graph export instead of the database'),
+    )
+
+    def handle_noargs(self, **options):
+        started = time.time()
+        if options['graph']:
+            with graph_file.GraphFile(options['graph']) as f:
+                graph = related.LinkGraph((source, target) for source, target, _, public in f.edges() if public)
+        else:
+            graph = WikiPage.load_link_graph()
+        self.stdout.write('Loaded %d pages in %.1f s' % (len(graph), time.time() - started))
+
+        updated = WikiPage.update_related_links_of(graph=graph, restart=options['restart'],
+                                                   iterations=options['iterations'])
+        self.stdout.write('Updated %d pages in %.1f s' % (len(updated), time.time() - started))
@@ -0,0 +1,16 @@
+from models import WikiPage
+
+
+class IdentityMapMiddleware(object):
+    """Share WikiPage instances loaded by get_by_title within a request"""
+    def process_request(self, request):
+        # a map left open by a failed request of this thread should not leak into this one
+        WikiPage.discard_identity_map()
+        WikiPage.open_identity_map()
+
+    def process_response(self, request, response):
+        WikiPage.discard_identity_map()
+        return response
+
+    def process_exception(self, request, exception):
+        WikiPage.discard_identity_map()
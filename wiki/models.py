@@ -1,24 +1,34 @@
 import re
+import sys
 import random
 import operator
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import chain
 from collections import OrderedDict
 import yaml
 
 from django.utils.timezone import utc
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Q, F, Count
 from django.contrib.auth.models import User
 from jsonfield import JSONField
 
 from lib.bzrlib.merge3 import Merge3
 from markdownext import md_wikilink
-from page_operation_mixin import PageOperationMixin, md
+from page_operation_mixin import PageOperationMixin
 from utils import merge_dicts
 import schema
 import caching
 from toc_generator import TocGenerator
 import wiki_settings
 import search
+import related
+
+
+# pages loaded by WikiPage.get_by_title while an identity map is open
+_identity_map = threading.local()
 
 
 class ConflictError(ValueError):
@@ -64,42 +74,63 @@ class SchemaDataIndex(models.Model):
     title = models.CharField(max_length=255)
     name = models.CharField(max_length=255)
     value = models.CharField(max_length=255)
+    # sort key of numbers and dates. see schema.Property.to_number()
+    number = models.FloatField(null=True)
     objects = SchemaDataIndexManager()
 
+    class Meta:
+        index_together = [
+            ('name', 'value'),
+            ('name', 'number'),
+            ('title', 'name', 'value'),
+        ]
+
+    # number of rows handled by a single query. keeps sqlite under its limit of 999 variables
+    batch_size = 100
+
     def __str__(self):
         return self.title + ' : ' + self.name + ' : ' + self.value
 
     @classmethod
     def rebuild_index(cls, title, data):
-        # delete
-        SchemaDataIndex.objects.filter(title=title).delete()
-
-        # insert
-        for name, v in cls.data_as_pairs(data):
-            if not isinstance(v, schema.Property) or v.should_index():
-                i = SchemaDataIndex(title=title, name=name, value=(v.pvalue if isinstance(v, schema.Property) else v))
-                i.save()
+        with transaction.atomic():
+            SchemaDataIndex.objects.filter(title=title).delete()
+            SchemaDataIndex.objects.bulk_create(cls._entities(title, set(cls._indexed_rows(cls.data_as_pairs(data)))),
+                                                batch_size=cls.batch_size)
 
     @classmethod
-    def update_index(cls, title, old_data, new_data):
-        old_pairs = cls.data_as_pairs(old_data)
-        new_pairs = cls.data_as_pairs(new_data)
+    def update_index(cls, title, new_data):
+        """Update index rows of title to new data. Returns True if indexed values are changed"""
+        old_rows = set(SchemaDataIndex.objects.filter(title=title).values_list('name', 'value', 'number'))
+        new_rows = set(cls._indexed_rows(cls.data_as_pairs(new_data)))
+
+        deletes = list(old_rows.difference(new_rows))
+        inserts = new_rows.difference(old_rows)
 
-        deletes = old_pairs.difference(new_pairs)
-        inserts = new_pairs.difference(old_pairs)
+        with transaction.atomic():
+            # delete
+            for i in range(0, len(deletes), cls.batch_size):
+                batch = deletes[i:i + cls.batch_size]
+                matches = reduce(operator.or_, (Q(name=name, value=value) for name, value, _ in batch))
+                SchemaDataIndex.objects.filter(matches, title=title).delete()
 
-        # delete
-        for name, v in deletes:
-            if not isinstance(v, schema.Property) or v.should_index():
-                entities = SchemaDataIndex.objects.filter(title=title, name=name, value=unicode(v.pvalue if isinstance(v, schema.Property) else v))
-                for e in entities:
-                    e.delete()
+            # insert
+            SchemaDataIndex.objects.bulk_create(cls._entities(title, inserts), batch_size=cls.batch_size)
 
-        # insert
-        for name, v in inserts:
-            if not isinstance(v, schema.Property) or v.should_index():
-                i = SchemaDataIndex(title=title, name=name, value=(v.pvalue if isinstance(v, schema.Property) else v))
-                i.save()
+        return len(deletes) > 0 or len(inserts) > 0
+
+    @classmethod
+    def _indexed_rows(cls, pairs):
+        """Yields (name, value, number) of pairs to be indexed"""
+        for name, v in pairs:
+            if not isinstance(v, schema.Property):
+                yield name, unicode(v), None
+            elif v.should_index():
+                yield name, unicode(v.pvalue), v.to_number()
+
+    @classmethod
+    def _entities(cls, title, rows):
+        return [SchemaDataIndex(title=title, name=name, value=value, number=number) for name, value, number in rows]
 
     @staticmethod
     def data_as_pairs(data):
@@ -123,6 +154,695 @@ class SchemaDataIndex(models.Model):
     def has_match(cls, title, name, v):
         return SchemaDataIndex.objects.filter(title=title, name=name, value=unicode(v.pvalue if isinstance(v, schema.Property) else v)).count() > 0
 
+    @classmethod
+    def values_of(cls, titles, names):
+        """Returns {title: {name: [value, ...]}} of given titles"""
+        values = {}
+        for i in range(0, len(titles), cls.batch_size):
+            rows = SchemaDataIndex.objects.filter(title__in=titles[i:i + cls.batch_size], name__in=names)
+            for title, name, value in rows.values_list('title', 'name', 'value'):
+                values.setdefault(title, {}).setdefault(name, []).append(value)
+        return values
+
+
+class WikiPageLink(models.Model):
+    """Link from a page to another page. Outlinks and inlinks of pages are made of these rows"""
+    source = models.CharField(max_length=255)
+    target = models.CharField(max_length=255)
+    rel = models.CharField(max_length=255)
+    # links of pages with a read restriction are not inlinks of target pages
+    public = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = [
+            ('source', 'target', 'rel'),
+        ]
+        index_together = [
+            ('target', 'public'),
+        ]
+
+    def __str__(self):
+        return self.source + ' -> ' + self.target + ' : ' + self.rel
+
+    @classmethod
+    def outlinks_of(cls, title):
+        return cls._to_dict(WikiPageLink.objects.filter(source=title).values_list('target', 'rel'))
+
+    @classmethod
+    def inlinks_of(cls, title):
+        return cls._to_dict(WikiPageLink.objects.filter(target=title, public=True).values_list('source', 'rel'))
+
+    @classmethod
+    def update_outlinks(cls, source, links, public):
+        """Replace outlinks of source with (target, rel) pairs.
+        Returns (target, rel) pairs of inlinks added to and removed from targets"""
+        links = set(links)
+        old = dict(((l.target, l.rel), l) for l in WikiPageLink.objects.filter(source=source))
+        old_inlinks = set(key for key, l in old.items() if l.public)
+        new_inlinks = links if public else set()
+
+        with transaction.atomic():
+            cls._delete_ids([old[key].id for key in set(old).difference(links)])
+            WikiPageLink.objects.bulk_create([WikiPageLink(source=source, target=target, rel=rel, public=public)
+                                              for target, rel in links.difference(old)],
+                                             batch_size=SchemaDataIndex.batch_size)
+            changed = [old[key].id for key in links.intersection(old) if old[key].public != public]
+            for ids in cls._batches(changed):
+                WikiPageLink.objects.filter(id__in=ids).update(public=public)
+
+        return new_inlinks.difference(old_inlinks), old_inlinks.difference(new_inlinks)
+
+    @classmethod
+    def delete_links(cls, source, targets):
+        """Delete links from source to targets. Returns (target, rel) pairs of removed inlinks"""
+        links = list(WikiPageLink.objects.filter(source=source, target__in=targets))
+        cls._delete_ids([l.id for l in links])
+        return set((l.target, l.rel) for l in links if l.public)
+
+    @classmethod
+    def move_inlinks(cls, old_target, new_target):
+        """Make pages linking to old_target link to new_target instead. Returns titles of the linking pages"""
+        links = list(WikiPageLink.objects.filter(target=old_target, public=True))
+        existing = set(WikiPageLink.objects.filter(target=new_target).values_list('source', 'rel'))
+
+        with transaction.atomic():
+            cls._delete_ids([l.id for l in links if (l.source, l.rel) in existing])
+            moved = [l.id for l in links if (l.source, l.rel) not in existing]
+            for ids in cls._batches(moved):
+                WikiPageLink.objects.filter(id__in=ids).update(target=new_target)
+
+        return set(l.source for l in links)
+
+    @classmethod
+    def _delete_ids(cls, ids):
+        for batch in cls._batches(ids):
+            WikiPageLink.objects.filter(id__in=batch).delete()
+
+    @staticmethod
+    def _batches(items):
+        for i in range(0, len(items), SchemaDataIndex.batch_size):
+            yield items[i:i + SchemaDataIndex.batch_size]
+
+    @staticmethod
+    def _to_dict(pairs):
+        links = {}
+        for title, rel in pairs:
+            links.setdefault(rel, []).append(title)
+        for titles in links.values():
+            titles.sort()
+        return links
+
+
+class PageRedirect(models.Model):
+    """Redirect of a page by .redirect metadata. Cycles are rejected when written"""
+    source = models.CharField(max_length=255, unique=True)
+    target = models.CharField(max_length=255)
+
+    def __str__(self):
+        return self.source + ' -> ' + self.target
+
+    @classmethod
+    def resolve(cls, title):
+        """Returns final title which title redirects to, or title itself"""
+        return cls.resolve_many([title])[title]
+
+    @classmethod
+    def resolve_many(cls, titles):
+        """Returns {title: final title} of titles. Each title is cached separately, so that the cache
+        doesn't hold a map of all redirects"""
+        resolved = getattr(_identity_map, 'redirects', None)
+        if resolved is None:
+            resolved = {}
+
+        missing = [t for t in set(titles) if t not in resolved]
+        if missing:
+            resolved.update(caching.get_redirects(missing))
+            missing = [t for t in missing if t not in resolved]
+        if missing:
+            found = cls._resolve_from_db(missing)
+            caching.set_redirects(found)
+            resolved.update(found)
+
+        return dict((t, resolved[t]) for t in titles)
+
+    @classmethod
+    def check(cls, source, target):
+        """Raise ValueError if redirecting source to target makes circular redirection"""
+        # read from the database, which is up to date while redirects are written
+        target_of = lambda title: PageRedirect.objects.filter(source=title).values_list('target', flat=True).first()
+        cls._check_cycle(target_of, source, target)
+
+    @staticmethod
+    def _check_cycle(target_of, source, target):
+        trail = {source}
+        while target is not None:
+            if target in trail:
+                raise ValueError('Circular redirection detected')
+            trail.add(target)
+            target = target_of(target)
+
+    @classmethod
+    def update(cls, source, target):
+        if target:
+            cls.check(source, target)
+            if PageRedirect.objects.filter(source=source).update(target=target) == 0:
+                PageRedirect(source=source, target=target).save()
+        else:
+            PageRedirect.objects.filter(source=source).delete()
+        cls._reset_redirects()
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild redirects from metadata of all pages. Returns titles of pages with circular redirection"""
+        direct = {}
+        circular = []
+        for page in WikiPage.objects.filter(body__contains=u'.redirect').iterator():
+            target = page.metadata.get(u'redirect')
+            if not target:
+                continue
+            try:
+                cls._check_cycle(direct.get, page.title, target)
+                direct[page.title] = target
+            except ValueError:
+                circular.append(page.title)
+
+        with transaction.atomic():
+            PageRedirect.objects.all().delete()
+            PageRedirect.objects.bulk_create([PageRedirect(source=source, target=target)
+                                              for source, target in direct.items()],
+                                             batch_size=SchemaDataIndex.batch_size)
+        cls._reset_redirects()
+        return circular
+
+    @classmethod
+    def _resolve_from_db(cls, titles):
+        # follow all chains at once, a step per query
+        direct = {}
+        queried = set()
+        step = list(set(titles))
+        while step:
+            queried.update(step)
+            for i in range(0, len(step), SchemaDataIndex.batch_size):
+                redirects = PageRedirect.objects.filter(source__in=step[i:i + SchemaDataIndex.batch_size])
+                direct.update(redirects.values_list('source', 'target'))
+            step = list(set(direct.values()).difference(queried))
+        # titles on the way are resolved as well
+        return dict((title, cls._final_target(direct, title)) for title in queried)
+
+    @classmethod
+    def _reset_redirects(cls):
+        caching.del_redirects()
+        if getattr(_identity_map, 'redirects', None) is not None:
+            _identity_map.redirects = {}
+
+    @staticmethod
+    def _final_target(direct, source):
+        """Returns final target of source. Source is left unresolved if it leads to a cycle,
+        which may be stored before cycles were rejected"""
+        title = source
+        trail = {title}
+        while title in direct:
+            title = direct[title]
+            if title in trail:
+                return source
+            trail.add(title)
+        return title
+
+
+class PageLinkStat(models.Model):
+    """Existence and number of public inlinks of a page. Kept for pages which exist or are linked.
+    Orphans are existing pages without inlinks and wanted pages are linked pages which don't exist"""
+    title = models.CharField(max_length=255, unique=True)
+    exists = models.BooleanField(default=False)
+    inlink_count = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ('exists', 'inlink_count', 'title'),
+        ]
+
+    def __str__(self):
+        return self.title + ' : ' + str(self.inlink_count)
+
+    @classmethod
+    def orphans(cls, index=0, count=50):
+        offset = index * count
+        stats = PageLinkStat.objects.filter(exists=True, inlink_count=0).order_by('title')
+        return list(stats.values_list('title', flat=True)[offset:offset + count])
+
+    @classmethod
+    def wanted(cls, index=0, count=50):
+        offset = index * count
+        stats = PageLinkStat.objects.filter(exists=False, inlink_count__gt=0).order_by('title')
+        return list(stats.values_list('title', 'inlink_count')[offset:offset + count])
+
+    @classmethod
+    def refresh(cls, titles):
+        """Recount stats of given titles"""
+        titles = list(set(t for t in titles if t))
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            batch = titles[i:i + SchemaDataIndex.batch_size]
+            links = WikiPageLink.objects.filter(target__in=batch, public=True)
+            counts = dict(links.values('target').annotate(count=Count('id')).values_list('target', 'count'))
+            existing = set(WikiPage.objects.filter(title__in=batch, revision__gt=0).values_list('title', flat=True))
+            stats = dict((stat.title, stat) for stat in PageLinkStat.objects.filter(title__in=batch))
+
+            with transaction.atomic():
+                cls._update_stats(batch, counts, existing, stats)
+
+    @classmethod
+    def rebuild(cls):
+        """Recount stats of all pages"""
+        links = WikiPageLink.objects.filter(public=True)
+        counts = dict(links.values('target').annotate(count=Count('id')).values_list('target', 'count'))
+        existing = set(WikiPage.objects.filter(revision__gt=0).values_list('title', flat=True))
+
+        with transaction.atomic():
+            PageLinkStat.objects.all().delete()
+            cls._update_stats(existing.union(counts.keys()), counts, existing, {})
+
+    @classmethod
+    def _update_stats(cls, titles, counts, existing, stats):
+        created = []
+        deleted = []
+        for title in titles:
+            exists = title in existing
+            count = counts.get(title, 0)
+            stat = stats.get(title)
+            if not exists and count == 0:
+                if stat is not None:
+                    deleted.append(stat.id)
+            elif stat is None:
+                created.append(PageLinkStat(title=title, exists=exists, inlink_count=count))
+            elif stat.exists != exists or stat.inlink_count != count:
+                PageLinkStat.objects.filter(id=stat.id).update(exists=exists, inlink_count=count)
+
+        if deleted:
+            PageLinkStat.objects.filter(id__in=deleted).delete()
+        PageLinkStat.objects.bulk_create(created, batch_size=SchemaDataIndex.batch_size)
+
+
+class LinkJob(models.Model):
+    """Pending update of target pages of links added to or removed from a source page.
+    Jobs are run by process_link_jobs command when ASYNC_LINK_PROPAGATION is on"""
+    source = models.CharField(max_length=255)
+    user = models.ForeignKey(User, null=True)
+    added = JSONField(default=[])
+    removed = JSONField(default=[])
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(default='')
+    created_at = models.DateTimeField()
+
+    max_attempts = 5
+
+    def __str__(self):
+        return self.source + ' (%d attempts)' % self.attempts
+
+    @classmethod
+    def enqueue(cls, source, user, added, removed):
+        if len(added) == 0 and len(removed) == 0:
+            return None
+        if user is not None and user.is_anonymous():
+            user = None
+        job = LinkJob(source=source, user=user, added=sorted(added), removed=sorted(removed),
+                      created_at=datetime.utcnow().replace(tzinfo=utc))
+        job.save()
+        return job
+
+    @classmethod
+    def pending(cls):
+        return LinkJob.objects.filter(attempts__lt=cls.max_attempts).order_by('id')
+
+    @classmethod
+    def process(cls, limit=100):
+        """Run pending jobs in order. Returns number of succeeded jobs"""
+        done = 0
+        for job in cls.pending()[:limit]:
+            # claim the job. other worker may have taken it already
+            if LinkJob.objects.filter(id=job.id, attempts=job.attempts).update(attempts=F('attempts') + 1) == 0:
+                continue
+            try:
+                with transaction.atomic():
+                    job.run()
+                    job.delete()
+                done += 1
+            except Exception as e:
+                LinkJob.objects.filter(id=job.id).update(last_error=repr(e))
+        return done
+
+    def run(self):
+        """Apply the job to target pages. Running a job more than once is harmless"""
+        with WikiPage.identity_map():
+            page = WikiPage.get_by_title(self.source)
+            page.set_cur_user(self.user)
+            page._update_inlinks(set(tuple(link) for link in self.added),
+                                 set(tuple(link) for link in self.removed))
+
+
+class RenderedPage(models.Model):
+    """Durable copy of the rendered artifacts of the latest revision of a page"""
+    title = models.CharField(max_length=255, unique=True)
+    revision = models.IntegerField()
+    version = models.CharField(max_length=255)
+    body = models.TextField()
+    hashbangs = JSONField(default=[])
+    data = JSONField(default={})
+    metadata = JSONField(default={})
+
+    def __str__(self):
+        return self.title + ' : ' + str(self.revision)
+
+    def is_fresh(self, page):
+        return self.revision == page.revision and self.version == wiki_settings.VERSION
+
+    @classmethod
+    def get_for(cls, page):
+        try:
+            rendered = RenderedPage.objects.get(title=page.title)
+        except RenderedPage.DoesNotExist:
+            return None
+        return rendered if rendered.is_fresh(page) else None
+
+    @classmethod
+    def store(cls, page, body, hashbangs, data, metadata):
+        rendered = RenderedPage(title=page.title, revision=page.revision, version=wiki_settings.VERSION,
+                                body=body, hashbangs=hashbangs, data=data, metadata=metadata)
+        fields = dict((name, getattr(rendered, name))
+                      for name in ('revision', 'version', 'body', 'hashbangs', 'data', 'metadata'))
+
+        with transaction.atomic():
+            if RenderedPage.objects.filter(title=page.title).update(**fields) == 0:
+                try:
+                    with transaction.atomic():
+                        rendered.save()
+                except IntegrityError:
+                    # stored by other request meanwhile
+                    RenderedPage.objects.filter(title=page.title).update(**fields)
+        return rendered
+
+    @classmethod
+    def invalidate(cls, titles):
+        titles = [t for t in titles if t]
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            RenderedPage.objects.filter(title__in=titles[i:i + SchemaDataIndex.batch_size]).delete()
+
+
+class Title(models.Model):
+    """Integer id of a title. Score vectors refer to titles by these ids"""
+    title = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def ids_of(cls, titles):
+        """Returns {title: id}. Ids of new titles are created, so call this only when pages or links are stored"""
+        titles = list(set(titles))
+        ids = cls.existing_ids_of(titles)
+        missing = [t for t in titles if t not in ids]
+        if missing:
+            try:
+                with transaction.atomic():
+                    Title.objects.bulk_create([Title(title=t) for t in missing],
+                                              batch_size=SchemaDataIndex.batch_size)
+            except IntegrityError:
+                # some of them are created by other request meanwhile
+                for t in missing:
+                    Title.objects.get_or_create(title=t)
+            ids.update(cls.existing_ids_of(missing))
+        return ids
+
+    @classmethod
+    def titles_of(cls, ids):
+        """Returns {id: title}"""
+        ids = list(set(ids))
+        titles = {}
+        for i in range(0, len(ids), SchemaDataIndex.batch_size):
+            titles.update(Title.objects.filter(id__in=ids[i:i + SchemaDataIndex.batch_size]).values_list('id', 'title'))
+        return titles
+
+    @classmethod
+    def existing_ids_of(cls, titles):
+        """Returns {title: id} of titles which have ids"""
+        titles = list(set(titles))
+        ids = {}
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            batch = titles[i:i + SchemaDataIndex.batch_size]
+            ids.update(Title.objects.filter(title__in=batch).values_list('title', 'id'))
+        return ids
+
+
+class LinkScoreTable(models.Model):
+    """Scores of pages linked from, linked to or related to a page. Materialized for related page search"""
+    title = models.CharField(max_length=255, unique=True)
+    # [title id, score] pairs ordered by id
+    scores = JSONField(default=[])
+
+    def __str__(self):
+        return self.title
+
+    @classmethod
+    def vectors_of(cls, pages):
+        """Returns {title: [title id, score] pairs ordered by id} of pages. Missing ones are built and stored.
+        Pages which do not exist have empty vectors which are not stored"""
+        vectors = dict((t.title, t.scores) for t in LinkScoreTable.objects.filter(title__in=[p.title for p in pages]))
+        for page in pages:
+            if page.title in vectors:
+                continue
+            if page.id is None:
+                vectors[page.title] = []
+                continue
+            vectors[page.title] = cls.build(page)
+            try:
+                with transaction.atomic():
+                    LinkScoreTable(title=page.title, scores=vectors[page.title]).save()
+            except IntegrityError:
+                # stored by other request meanwhile
+                pass
+        return vectors
+
+    @classmethod
+    def build(cls, page):
+        related_links = page.related_links
+        inout_links = set(chain(chain(*page.inlinks.values()), chain(*page.outlinks.values())))
+        inout_links.difference_update(related_links.keys())
+        inout_score = 1.0 / len(inout_links) if len(inout_links) != 0 else 0.0
+
+        scores = dict.fromkeys(inout_links, inout_score)
+        scores.update(related_links)
+        # ids are created when links are stored. titles without ids are not linked from any stored page
+        ids = Title.existing_ids_of(scores.keys())
+        return sorted([ids[title], score] for title, score in scores.items() if title in ids)
+
+    @classmethod
+    def invalidate(cls, titles):
+        titles = [t for t in titles if t]
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            LinkScoreTable.objects.filter(title__in=titles[i:i + SchemaDataIndex.batch_size]).delete()
+
+
+class WikiqueryPlan(object):
+    """Parsed wikiquery whose page query is compiled into a single SQL statement.
+    Plans are cached by query text in each process until the schema generation is bumped,
+    which happens when rebuild_schema_index is run or the whole cache is flushed"""
+    max_cached = 1000
+    _cache = {}
+    _schema_generation = None
+
+    def __init__(self, q):
+        self.page_query, self.attrs, self.sort_criteria = search.parse_wikiquery(q)
+        titles = WikiPage.objects.filter(self._compile(self.page_query)).values_list('title', flat=True)
+        self.sql, self.params = titles.query.sql_with_params()
+        self.sorted_in_db = all(self.is_indexed(attr) for attr, _ in self.sort_criteria)
+        self.sorted_sql, self.sorted_params = self._compile_order()
+
+    @classmethod
+    def get(cls, q):
+        # plans depend on schema, e.g. which properties are indexed or compared as numbers
+        generation = caching.get_schema_generation()
+        if generation != cls._schema_generation:
+            cls._cache.clear()
+            cls._schema_generation = generation
+
+        plan = cls._cache.get(q)
+        if plan is None:
+            plan = WikiqueryPlan(q)
+            if len(cls._cache) >= cls.max_cached:
+                cls._cache.clear()
+            cls._cache[q] = plan
+        return plan
+
+    def titles(self):
+        cursor = connection.cursor()
+        cursor.execute(self.sql, self.params)
+        return set(row[0] for row in cursor.fetchall())
+
+    def sorted_titles(self, offset=0, count=None):
+        """Returns titles of matching pages ordered by sort criteria and then by title.
+        Sorted by the database, so only count titles from offset are read"""
+        # negative LIMIT means no limit in some databases
+        offset = max(offset, 0)
+        sql = self.sorted_sql
+        if count is not None:
+            sql += ' LIMIT %d OFFSET %d' % (max(count, 0), offset)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, self.sorted_params)
+        titles = [row[0] for row in cursor.fetchall()]
+        return titles if count is not None else titles[offset:]
+
+    def data_of(self, titles, attrs):
+        """Returns {title: data} of given titles, including attrs. Values are read from SchemaDataIndex
+        and pages are loaded only if some attrs are not indexed or a page is a redirect"""
+        indexed = all(self.is_indexed(attr) for attr in attrs)
+        if indexed:
+            values = SchemaDataIndex.values_of(titles, attrs + [u'schema'])
+
+        data = {}
+        resolved = PageRedirect.resolve_many(titles)
+        for title in titles:
+            if indexed and resolved[title] == title:
+                data[title] = self.typed_data(values.get(title, {}))
+            else:
+                data[title] = WikiPage.get_by_title(title, follow_redirect=True).data
+        return data
+
+    @staticmethod
+    def is_indexed(attr):
+        """True if values of attr can be read from SchemaDataIndex. Long texts and unknown properties are not indexed"""
+        if attr in (u'name', u'schema'):
+            return True
+        try:
+            return u'LongText' not in schema.get_property(attr)['ranges']
+        except KeyError:
+            return False
+
+    @staticmethod
+    def sort_key(value):
+        if type(value) == list:
+            value = value[0] if len(value) > 0 else None
+        if isinstance(value, schema.Property):
+            return value.to_number(), value.pvalue
+        return None, value
+
+    @staticmethod
+    def typed_data(values):
+        """Convert index values of a page, as returned by SchemaDataIndex.values_of, to properties like WikiPage.data.
+        The index doesn't keep the order of values in a page, so multiple values are sorted"""
+        paths = values.get(u'schema')
+        itemtype = paths[0].strip('/').split('/')[-1] if paths else u'Article'
+
+        data = {}
+        for name, pvalues in values.items():
+            if len(pvalues) == 1:
+                pvalue = pvalues[0]
+            else:
+                pvalues = sorted(pvalues)
+                cto = schema.get_cardinality(itemtype, name)[1]
+                pvalue = pvalues[0] if cto == 1 else pvalues[:cto] if cto != 0 else pvalues
+            data[name] = schema.SchemaConverter.convert_prop(itemtype, name, pvalue)
+        return data
+
+    def _compile_order(self):
+        """Compile a query of matching titles ordered by sort criteria. A page with multiple values is
+        ordered by the smallest value, or by the largest one in descending order. Pages without values
+        come last. Criteria which are not indexed are ignored here and sorted by WikiPage.wikiquery_titles"""
+        qn = connection.ops.quote_name
+        page = qn(WikiPage._meta.db_table)
+        joins = []
+        orders = []
+        params = []
+        if self.sorted_in_db:
+            for i, (attr, order) in enumerate(self.sort_criteria):
+                alias = qn('s%d' % i)
+                joins.append('LEFT OUTER JOIN %s %s ON %s.%s = %s.%s AND %s.%s = %%s' % (
+                    qn(SchemaDataIndex._meta.db_table), alias, alias, qn('title'), page, qn('title'), alias, qn('name')))
+                params.append(attr)
+
+                func, direction = ('MAX', 'DESC') if order == '-' else ('MIN', 'ASC')
+                orders += [
+                    '%s(%s.%s) IS NULL' % (func, alias, qn('value')),
+                    '%s(%s.%s) %s' % (func, alias, qn('number'), direction),
+                    '%s(%s.%s) %s' % (func, alias, qn('value'), direction),
+                ]
+        orders.append('%s.%s' % (page, qn('title')))
+
+        sql = 'SELECT %s.%s FROM %s %s WHERE %s.%s IN (%s) GROUP BY %s.%s ORDER BY %s' % (
+            page, qn('title'), page, ' '.join(joins), page, qn('title'), self.sql, page, qn('title'), ', '.join(orders))
+        return sql, tuple(params) + tuple(self.params)
+
+    @classmethod
+    def _compile(cls, q):
+        if len(q) == 1:
+            return cls._compile(q[0])
+        elif isinstance(q[0], basestring):
+            return cls._compile_term(q[0], q[1:])
+        else:
+            return cls._compile_expr(q[0], q[1], q[2:])
+
+    @classmethod
+    def _compile_term(cls, name, args):
+        if len(args) > 1:
+            indexes = SchemaDataIndex.objects.filter(cls._compile_range(name, args[0], args[1:]), name=name)
+        elif args[0].endswith(u'*'):
+            # prefix is scanned as a range of the (name, value) index
+            prefix = args[0][:-1]
+            indexes = SchemaDataIndex.objects.filter(name=name, value__gte=prefix)
+            end = cls._prefix_end(prefix)
+            if end is not None:
+                indexes = indexes.filter(value__lt=end)
+        else:
+            value = args[0]
+            if name == 'schema' and value.find('/') == -1:
+                value = schema.get_itemtype_path(value)
+            indexes = SchemaDataIndex.objects.filter(name=name, value=value)
+        return Q(title__in=indexes.values('title'))
+
+    @staticmethod
+    def _prefix_end(prefix):
+        """Returns the least text greater than all texts starting with prefix, or None if there's no such text"""
+        prefix = prefix.rstrip(unichr(sys.maxunicode))
+        if not prefix:
+            return None
+        return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+    @classmethod
+    def _compile_range(cls, name, op, values):
+        """Compare numbers if values are numbers or dates of the property, or compare texts otherwise"""
+        bounds = [cls._number_range(name, value) for value in values]
+        if None in bounds:
+            column = 'value'
+            bounds = [(value, value) for value in values]
+        else:
+            column = 'number'
+
+        if op == '>':
+            return Q(**{column + '__gt': bounds[0][1]})
+        elif op == '<':
+            return Q(**{column + '__lt': bounds[0][0]})
+        elif op == '..':
+            return Q(**{column + '__gte': bounds[0][0], column + '__lte': bounds[1][1]})
+        raise ValueError('Invalid operator: %s' % op)
+
+    @staticmethod
+    def _number_range(name, value):
+        try:
+            prop = schema.SchemaConverter.convert_prop(u'Thing', name, value)
+        except KeyError:
+            return None
+        return prop.to_number_range()
+
+    @classmethod
+    def _compile_expr(cls, operand, op, rest):
+        q1 = cls._compile(operand)
+        q2 = cls._compile(rest)
+
+        if op == '*':
+            return q1 & q2
+        elif op == '+':
+            return q1 | q2
+        raise ValueError('Invalid operator: %s' % op)
+
 
 class WikiPage(models.Model, PageOperationMixin):
     re_normalize_title = re.compile(ur'([\[\]\(\)\~\!\@\#\$\%\^\&\*\-'
@@ -130,7 +850,7 @@ class WikiPage(models.Model, PageOperationMixin):
                                     ur'\bthe\b|\ban?\b)')
 
     itemtype_path = models.CharField(max_length=255)
-    title = models.CharField(max_length=255)
+    title = models.CharField(max_length=255, unique=True)
     body = models.TextField()
     description = models.CharField(max_length=255)
     comment = models.CharField(max_length=999)
@@ -138,20 +858,30 @@ class WikiPage(models.Model, PageOperationMixin):
     acl_read = models.CharField(max_length=255)
     acl_write = models.CharField(max_length=255)
     revision = models.IntegerField()
-    updated_at = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(null=True, db_index=True)
 
     published_at = models.DateTimeField(null=True)
     published_to = models.CharField(max_length=255, null=True)
     older_title = models.CharField(max_length=255, null=True)
     newer_title = models.CharField(max_length=255, null=True)
 
-    _inlinks = JSONField(default={})
-    _outlinks = JSONField(default={})
     _related_links = JSONField(default={})
 
+    class Meta:
+        index_together = [
+            ('published_to', 'published_at'),
+        ]
+
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        super(WikiPage, self).save(*args, **kwargs)
+        if getattr(self, '_related_links_changed', False):
+            self._related_links_changed = False
+            Title.ids_of([self.title] + self.related_links.keys())
+            LinkScoreTable.invalidate([self.title])
+
     @property
     def is_old_revision(self):
         return False
@@ -160,15 +890,28 @@ class WikiPage(models.Model, PageOperationMixin):
     def rendered_body(self):
         value = caching.get_rendered_body(self.title)
         if value is None:
-            value = super(WikiPage, self).rendered_body
-            caching.set_rendered_body(self.title, value)
+            rendered = self.rendered_page
+            if rendered is not None:
+                value, hashbangs = rendered.body, rendered.hashbangs
+            else:
+                value = super(WikiPage, self).rendered_body
+                hashbangs = PageOperationMixin.extract_hashbangs(value)
+                self._store_rendered_page(value, hashbangs)
+
+            # cache artifacts derived from rendered html together with it
+            caching.set_rendered(self.title, value, hashbangs)
         return value
 
     @property
     def data(self):
         value = caching.get_data(self.title)
         if value is None:
-            value = super(WikiPage, self).data
+            rendered = self.rendered_page
+            if rendered is not None:
+                value = schema.SchemaConverter.convert(self.itemtype, rendered.data)
+                value['datePageModified'] = schema.DateTimeProperty(self.itemtype, 'DateTime', 'datePageModified', self.updated_at)
+            else:
+                value = super(WikiPage, self).data
             caching.set_data(self.title, value)
         return value
 
@@ -176,7 +919,11 @@ class WikiPage(models.Model, PageOperationMixin):
     def metadata(self):
         value = caching.get_metadata(self.title)
         if value is None:
-            value = super(WikiPage, self).metadata
+            rendered = self.rendered_page
+            if rendered is not None:
+                value = rendered.metadata
+            else:
+                value = super(WikiPage, self).metadata
             caching.set_metadata(self.title, value)
         return value
 
@@ -184,30 +931,34 @@ class WikiPage(models.Model, PageOperationMixin):
     def hashbangs(self):
         value = caching.get_hashbangs(self.title)
         if value is None:
-            value = super(WikiPage, self).hashbangs
+            rendered = self.rendered_page
+            if rendered is not None:
+                value = rendered.hashbangs
+            else:
+                value = super(WikiPage, self).hashbangs
             caching.set_hashbangs(self.title, value)
         return value
 
     @property
-    def link_scoretable(self):
-        """Returns all links ordered by score"""
-
-        # related links
-        related_links_scoretable = self.related_links
+    def rendered_page(self):
+        """Stored rendering of the current revision or None"""
+        if self.revision == 0:
+            return None
 
-        # in/out links
-        inlinks = reduce(lambda a, b: a + b, self.inlinks.values(), [])
-        outlinks = reduce(lambda a, b: a + b, self.outlinks.values(), [])
-        inout_links = set(inlinks + outlinks).difference(related_links_scoretable.keys())
-        inout_links_len = len(inout_links)
-        inout_score = 1.0 / inout_links_len if inout_links_len != 0 else 0.0
-        inout_links_scoretable = dict(zip(inout_links, [inout_score] * inout_links_len))
+        rendered = getattr(self, '_rendered_page', None)
+        if rendered is None or not rendered.is_fresh(self):
+            rendered = RenderedPage.get_for(self)
+            self._rendered_page = rendered
+        return rendered
 
-        scoretable = dict(inout_links_scoretable.items() + related_links_scoretable.items())
-        sorted_scoretable = sorted(scoretable.iteritems(),
-                                   key=operator.itemgetter(1),
-                                   reverse=True)
-        return OrderedDict(sorted_scoretable)
+    @property
+    def link_scoretable(self):
+        """Returns all links ordered by score"""
+        vector = LinkScoreTable.vectors_of([self])[self.title]
+        titles = Title.titles_of(title_id for title_id, _ in vector)
+        scoretable = sorted(((titles[title_id], score) for title_id, score in vector),
+                            key=lambda (title, score): (-score, title))
+        return OrderedDict(scoretable)
 
     @property
     def user_can_write(self):
@@ -235,6 +986,30 @@ class WikiPage(models.Model, PageOperationMixin):
 
         return page
 
+    @staticmethod
+    def _invalidate_rendered(titles):
+        titles = [title for title in titles if title]
+        caching.del_rendered(titles)
+        RenderedPage.invalidate(titles)
+
+        # loaded pages must not keep using the deleted rendering
+        loaded = WikiPage._loaded_pages()
+        for title in titles:
+            if title in loaded:
+                loaded[title]._rendered_page = None
+
+    def _store_rendered_page(self, rendered_body, hashbangs):
+        if self.revision == 0:
+            return
+
+        try:
+            metadata = self.metadata
+            data = dict((k, v) for k, v in self.rawdata.items() if k != 'datePageModified')
+        except ValueError:
+            return
+
+        self._rendered_page = RenderedPage.store(self, rendered_body, hashbangs, data, metadata)
+
     def can_write(self, user, default_acl=None, acl_r=None, acl_w=None):
         if user and user.is_anonymous():
             user = None
@@ -252,32 +1027,43 @@ class WikiPage(models.Model, PageOperationMixin):
     def delete(self, user=None):
         if not user or user.is_anonymous() or not user.is_superuser:
             raise RuntimeError('Only admin can delete pages.')
+        self._delete(user)
 
+    def _delete(self, user):
         self.update_content('', self.revision, user=user, dont_create_rev=True)
-        self._update_inlinks({}, {'relatedTo': [p[0] for p in self.paths[:-1]]})
+        removed = WikiPageLink.delete_links(self.title, [p[0] for p in self.paths[:-1]])
+        self._propagate_links(set(), removed)
+        self.reset_links()
         self.related_links = {}
         self.modifier = None
         self.updated_at = None
         self.revision = 0
         self.save()
+        PageLinkStat.refresh([self.title] + [title for title, _ in removed])
 
         for r in self.revisions.all():
             r.delete()
 
+        WikiPage._invalidate_rendered([self.title])
+        self._rendered_page = None
         caching.del_titles()
 
     def update_content(self, content, base_revision, comment='', user=None, force_update=False, dont_create_rev=False,
                        partial='all'):
         content = content.replace('\r\n', '\n')
 
-        if partial == 'all':
-            return self._update_content_all(content, base_revision, comment, user, force_update, dont_create_rev)
-        elif partial.startswith('checkbox'):
-            return self._update_content_checkbox(content, base_revision, comment, user, force_update, dont_create_rev, partial)
-        elif partial.startswith('log'):
-            return self._update_content_log(content, base_revision, comment, user, force_update, dont_create_rev, partial)
-        else:
-            raise ValueError('Invalid partial expression: %s' % partial)
+        with WikiPage.identity_map():
+            # make pages loaded while updating see this instance
+            WikiPage._loaded_pages()[self.title] = self
+
+            if partial == 'all':
+                return self._update_content_all(content, base_revision, comment, user, force_update, dont_create_rev)
+            elif partial.startswith('checkbox'):
+                return self._update_content_checkbox(content, base_revision, comment, user, force_update, dont_create_rev, partial)
+            elif partial.startswith('log'):
+                return self._update_content_log(content, base_revision, comment, user, force_update, dont_create_rev, partial)
+            else:
+                raise ValueError('Invalid partial expression: %s' % partial)
 
     def _update_content_checkbox(self, content, base_revision, comment, user, force_update, dont_create_rev, exp):
         cur_index = {'value': -1}
@@ -322,20 +1108,15 @@ class WikiPage(models.Model, PageOperationMixin):
         new_data, new_md = self.validate_new_content(base_revision, body, user)
         new_body = self._merge_if_needed(base_revision, body)
 
-        # get old data and metadata
+        # get old metadata
         try:
             old_md = self.metadata.copy()
         except ValueError:
             old_md = {}
 
-        try:
-            old_data = self.data.copy()
-        except ValueError:
-            old_data = {}
-
         # delete caches
-        caching.del_rendered_body(self.title)
-        caching.del_hashbangs(self.title)
+        WikiPage._invalidate_rendered([self.title])
+        self._rendered_page = None
         caching.del_metadata(self.title)
         caching.del_data(self.title)
 
@@ -362,7 +1143,7 @@ class WikiPage(models.Model, PageOperationMixin):
                                    comment=self.comment, modifier=self.modifier)
             rev.save()
 
-        self.update_links_and_data(old_md.get('redirect'), new_md.get('redirect'), old_data, new_data)
+        self.update_links_and_data(old_md.get('redirect'), new_md.get('redirect'), new_data)
 
         # delete config cache
         if self.title == '.config':
@@ -372,6 +1153,9 @@ class WikiPage(models.Model, PageOperationMixin):
         if self.revision == 1:
             caching.del_titles()
 
+        # prime rendered body cache and store
+        self.rendered_body
+
         return True
 
     def _merge_if_needed(self, base_revision, new_body):
@@ -401,10 +1185,7 @@ class WikiPage(models.Model, PageOperationMixin):
             raise ValueError('Cannot restrict your permission')
 
         # prevent circular-redirection
-        try:
-            WikiPage._follow_redirect(self, new_md.get(u'redirect'))
-        except ValueError as e:
-            raise e
+        PageRedirect.check(self.title, new_md.get(u'redirect'))
 
         # check data
         new_data = PageOperationMixin.parse_data(self.title, new_body, new_md['schema'])
@@ -416,86 +1197,88 @@ class WikiPage(models.Model, PageOperationMixin):
         if self.revision < base_revision:
             raise ValueError('Invalid revision number: %d' % base_revision)
 
-        # check headings
-        invalid_reason = TocGenerator(md.convert(new_body)).is_invalid()
+        # check headings. rendered blocks are cached and reused when the page is rendered after saving
+        rendered = PageOperationMixin.render_markdown(PageOperationMixin.remove_metadata(new_body))
+        invalid_reason = TocGenerator(rendered).is_invalid()
         if invalid_reason:
             raise ValueError(invalid_reason)
 
         return new_data, new_md
 
-    def update_links_and_data(self, old_redir, new_redir, old_data, new_data):
+    def update_links_and_data(self, old_redir, new_redir, new_data):
+        """Returns True if indexed data is changed"""
         self.update_links(old_redir, new_redir)
-        SchemaDataIndex.update_index(self.title, old_data, new_data)
+        return SchemaDataIndex.update_index(self.title, new_data)
 
     def update_links(self, old_redir, new_redir):
         """Updates outlinks of this page and inlinks of target pages"""
         # 1. process "redirect" metadata
+        if old_redir != new_redir:
+            PageRedirect.update(self.title, new_redir)
         self._update_redirected_links(new_redir, old_redir)
 
-        # 2. update inlinks
-        cur_outlinks = self.outlinks
-        new_outlinks = {}
-        for rel, titles in self._parse_outlinks().items():
-            new_outlinks[rel] = list({WikiPage.get_by_title(t, follow_redirect=True).title for t in titles})
-        if self.acl_read:
-            # delete all inlinks of target pages if the source page has a read restriction
-            added_outlinks = {}
-            removed_outlinks = cur_outlinks
+        # 2. update outlinks
+        parsed_outlinks = self._parse_outlinks()
+        targets = [t for titles in parsed_outlinks.values() for t in titles]
+        # redirects of all targets are resolved at once, and get_by_title finds them in the identity map
+        PageRedirect.resolve_many(targets)
+        WikiPage.prefetch(targets)
+        new_links = set()
+        for rel, titles in parsed_outlinks.items():
+            new_links.update((WikiPage.get_by_title(t, follow_redirect=True).title, rel) for t in titles)
+
+        # inlinks of target pages are removed if the source page has a read restriction
+        added, removed = WikiPageLink.update_outlinks(self.title, new_links, not self.acl_read)
+        Title.ids_of([self.title] + [title for title, _ in new_links])
+        self.reset_links()
+        LinkScoreTable.invalidate([self.title])
+
+        # 3. update target pages
+        PageLinkStat.refresh([self.title] + [title for title, _ in added.union(removed)])
+        self._propagate_links(added, removed)
+
+    def _propagate_links(self, added, removed):
+        if wiki_settings.ASYNC_LINK_PROPAGATION:
+            LinkJob.enqueue(self.title, self.cur_user, added, removed)
         else:
-            added_outlinks = {}
-            for rel, titles in new_outlinks.items():
-                added_outlinks[rel] = titles
-                if rel in cur_outlinks:
-                    added_outlinks[rel] = set(added_outlinks[rel]).difference(cur_outlinks[rel])
-            removed_outlinks = {}
-            for rel, titles in cur_outlinks.items():
-                removed_outlinks[rel] = titles
-                if rel in new_outlinks:
-                    removed_outlinks[rel] = set(removed_outlinks[rel]).difference(new_outlinks[rel])
-
-        self._update_inlinks(added_outlinks, removed_outlinks)
-
-        [new_outlinks[rel].sort() for rel in new_outlinks.keys()]
-        self.outlinks = new_outlinks
-        self.save()
-
-    def _update_inlinks(self, added_outlinks, removed_outlinks):
-        # handle added links
-        updates = []
-        for rel, titles in added_outlinks.items():
-            for title in titles:
-                page = WikiPage.get_by_title(title, follow_redirect=True)
-                page.add_inlink(self.title, rel)
+            self._update_inlinks(added, removed)
+
+    def _update_inlinks(self, added, removed):
+        """Create or delete target pages of added or removed (title, rel) inlinks"""
+        added_titles = set(title for title, _ in added)
+        removed_titles = set(title for title, _ in removed).difference(added_titles)
+        WikiPage.prefetch(added_titles.union(removed_titles))
+
+        for title in added_titles.union(removed_titles):
+            WikiPage.get_by_title(title).reset_links()
+        WikiPage._invalidate_rendered(added_titles.union(removed_titles))
+        LinkScoreTable.invalidate(added_titles.union(removed_titles))
+
+        # a retried job may be stale. don't create pages which the source doesn't link to anymore
+        linked = set()
+        for batch in WikiPageLink._batches(sorted(added_titles)):
+            linked.update(WikiPageLink.objects.filter(source=self.title, target__in=batch)
+                          .values_list('target', flat=True))
+
+        for title in added_titles.intersection(linked):
+            page = WikiPage.get_by_title(title)
+            if page.id is None:
                 page.save()
-                updates.append(page)
-
-        if updates:
-            for page in updates:
-                caching.del_rendered_body(page.title)
-                caching.del_hashbangs(page.title)
-
-        # handle removed links
-        updates = []
-        deletes = []
-        for rel, titles in removed_outlinks.items():
-            for title in titles:
-                page = WikiPage.get_by_title(title, follow_redirect=True)
-                page.del_inlink(self.title, rel)
-                if len(page.inlinks) == 0 and page.revision == 0 and page.id:
-                    deletes.append(page)
-                else:
-                    updates.append(page)
-
-        for page in updates + deletes:
-            caching.del_rendered_body(page.title)
-            caching.del_hashbangs(page.title)
-
-        for page in updates:
-            page.save()
-
-        for page in deletes:
-            page.set_cur_user(self.cur_user)
-            page.delete(self.cur_user)
+
+        for title in removed_titles:
+            page = WikiPage.get_by_title(title)
+            if len(page.inlinks) == 0 and page.revision == 0 and page.id:
+                # placeholder has no content, so anyone who removed the last link to it can delete it
+                page.set_cur_user(self.cur_user)
+                page._delete(self.cur_user)
+
+        if wiki_settings.INCREMENTAL_RELATED_LINKS and (added_titles or removed_titles):
+            # share the budget among this page and a few pages around it
+            changed = sorted(added_titles.union(removed_titles))
+            neighbours = sorted(set(WikiPage._link_neighbours([self.title])[self.title]).difference(changed))
+            titles = [self.title] + (changed + neighbours)[:9]
+            budget = wiki_settings.RELATED_LINKS_PUSH_BUDGET
+            WikiPage.update_related_links_locally(titles, max(budget / len(titles), 1))
 
     def _update_pub_state(self, new_md, old_md):
         pub_old = u'pub' in old_md
@@ -519,7 +1302,7 @@ class WikiPage(models.Model, PageOperationMixin):
         posts = WikiPage.get_posts_of(title, index=0, count=1)
 
         if len(posts) > 0:
-            latest = posts[0]
+            latest = WikiPage._identical(posts[0])
             latest.newer_title = self.title
             latest.save()
             self.older_title = latest.title
@@ -530,27 +1313,13 @@ class WikiPage(models.Model, PageOperationMixin):
         if save:
             self.save()
 
-        caching.del_rendered_body(self.title)
-        caching.del_hashbangs(self.title)
-        if self.newer_title:
-            caching.del_rendered_body(self.newer_title)
-            caching.del_hashbangs(self.newer_title)
-        if self.older_title:
-            caching.del_rendered_body(self.older_title)
-            caching.del_hashbangs(self.older_title)
+        WikiPage._invalidate_rendered([self.title, self.newer_title, self.older_title])
 
     def _unpublish(self, save):
         if self.published_at is None:
             return
 
-        caching.del_rendered_body(self.title)
-        caching.del_hashbangs(self.title)
-        if self.newer_title:
-            caching.del_rendered_body(self.newer_title)
-            caching.del_hashbangs(self.newer_title)
-        if self.older_title:
-            caching.del_rendered_body(self.older_title)
-            caching.del_hashbangs(self.older_title)
+        WikiPage._invalidate_rendered([self.title, self.newer_title, self.older_title])
 
         older = WikiPage.get_by_title(self.older_title)
         newer = WikiPage.get_by_title(self.newer_title)
@@ -588,62 +1357,28 @@ class WikiPage(models.Model, PageOperationMixin):
             return
         target = WikiPage.get_by_title(new_redir, follow_redirect=True) if new_redir else self
 
-        updates = [source, target]
-        for rel, titles in source.inlinks.items():
-            for t in titles:
-                page = WikiPage.get_by_title(t)
-                page.del_outlink(source.title, rel)
-                page.add_outlink(target.title, rel)
-                updates.append(page)
-            target.add_inlinks(source.inlinks[rel], rel)
-            del source.inlinks[rel]
+        linking_titles = WikiPageLink.move_inlinks(source.title, target.title)
+        WikiPage.prefetch(linking_titles)
+        updates = [source, target] + [WikiPage.get_by_title(t) for t in linking_titles]
 
         for p in updates:
-            p.save()
-
-        for page in updates:
-            caching.del_rendered_body(page.title)
-            caching.del_hashbangs(page.title)
+            p.reset_links()
+            if p.id is None:
+                p.save()
 
-    def update_related_links(self, max_distance=5):
-        """Update related_links score table by random walk"""
-        if len(self.outlinks) == 0:
-            return False
+        WikiPage._invalidate_rendered([page.title for page in updates])
+        LinkScoreTable.invalidate([page.title for page in updates])
+        PageLinkStat.refresh([source.title, target.title])
 
-        # random walk
-        score_table = self.related_links
-        updated = WikiPage._update_related_links(self, self, 0.1, score_table, max_distance)
-        if not updated:
+    def update_related_links(self):
+        """Update related_links score table from links around this page"""
+        updated = WikiPage.update_related_links_locally([self.title], wiki_settings.RELATED_LINKS_PUSH_BUDGET)
+        if self.title not in updated:
             return False
 
-        self.related_links = score_table
-        self.normalize_related_links()
+        self.related_links = updated[self.title]
         return True
 
-    def normalize_related_links(self):
-        related_links = self.related_links
-
-        # filter out obvious(direct) links
-        outlinks = reduce(lambda x, y: x + y, self.outlinks.values(), [])
-        inlinks = reduce(lambda x, y: x + y, self.inlinks.values(), [])
-        direct_links = set(outlinks + inlinks)
-        related_links = dict(filter(lambda (k, v): k not in direct_links, related_links.items()))
-
-        # filter out insignificant links
-        if len(related_links) > 30:
-            sorted_tuples = sorted(related_links.iteritems(),
-                                   key=operator.itemgetter(1))
-            related_links = OrderedDict(sorted_tuples[-30:])
-
-        # normalize score
-        total = sum(related_links.values())
-        if total > 1.0:
-            for link, score in related_links.items():
-                related_links[link] = score / total
-
-        # done
-        self.related_links = related_links
-
     def get_posts(self, index=0, count=50):
         return WikiPage.get_posts_of(self.title, index, count)
 
@@ -675,41 +1410,22 @@ class WikiPage(models.Model, PageOperationMixin):
         return dict((k, v) for k, v in merged.items()
                     if not((type(v) == list and self.title in v) or self.title == v))
 
-    def add_inlinks(self, titles, rel):
-        WikiPage._add_inout_links(self.inlinks, titles, rel)
-
-    def add_outlinks(self, titles, rel):
-        WikiPage._add_inout_links(self.outlinks, titles, rel)
-
-    def add_inlink(self, title, rel):
-        WikiPage._add_inout_link(self.inlinks, title, rel)
-
-    def add_outlink(self, title, rel):
-        WikiPage._add_inout_link(self.outlinks, title, rel)
-
-    def del_inlink(self, title, rel=None):
-        WikiPage._del_inout_link(self.inlinks, title, rel)
-
-    def del_outlink(self, title, rel=None):
-        WikiPage._del_inout_link(self.outlinks, title, rel)
-
-    def get_inlinks(self):
-        if not self._inlinks:
-            self._inlinks = {}
+    @property
+    def inlinks(self):
+        if getattr(self, '_inlinks', None) is None:
+            self._inlinks = WikiPageLink.inlinks_of(self.title)
         return self._inlinks
 
-    def set_inlinks(self, value):
-        self._inlinks = value
-    inlinks = property(get_inlinks, set_inlinks)
-
-    def get_outlinks(self):
-        if not self._outlinks:
-            self._outlinks = {}
+    @property
+    def outlinks(self):
+        if getattr(self, '_outlinks', None) is None:
+            self._outlinks = WikiPageLink.outlinks_of(self.title)
         return self._outlinks
 
-    def set_outlinks(self, value):
-        self._outlinks = value
-    outlinks = property(get_outlinks, set_outlinks)
+    def reset_links(self):
+        """Make inlinks and outlinks reloaded on next access"""
+        self._inlinks = None
+        self._outlinks = None
 
     def get_related_links(self):
         if not self._related_links:
@@ -718,6 +1434,7 @@ class WikiPage(models.Model, PageOperationMixin):
 
     def set_related_links(self, value):
         self._related_links = value
+        self._related_links_changed = True
     related_links = property(get_related_links, set_related_links)
 
     @classmethod
@@ -746,7 +1463,7 @@ class WikiPage(models.Model, PageOperationMixin):
         return result
 
     @classmethod
-    def search(cls, expression):
+    def search(cls, expression, k=None):
         # parse
         parsed = search.parse_expression(expression)
 
@@ -754,11 +1471,18 @@ class WikiPage(models.Model, PageOperationMixin):
         pos, neg = parsed['pos'], parsed['neg']
         pos_pages = [cls.get_by_title(t, True) for t in pos]
         neg_pages = [cls.get_by_title(t, True) for t in neg]
+        vectors = LinkScoreTable.vectors_of(pos_pages + neg_pages)
+        # operands without ids cannot appear in any vector, so their titles are used as keys
+        ids = Title.existing_ids_of(vectors.keys())
         scoretable = search.evaluate(
-            dict((page.title, page.link_scoretable) for page in pos_pages),
-            dict((page.title, page.link_scoretable) for page in neg_pages)
+            dict((ids.get(page.title, page.title), vectors[page.title]) for page in pos_pages),
+            dict((ids.get(page.title, page.title), vectors[page.title]) for page in neg_pages),
+            k
         )
-        return scoretable
+
+        # title ids to titles
+        titles = Title.titles_of(scoretable.keys())
+        return OrderedDict((titles[title_id], score) for title_id, score in scoretable.items())
 
     @classmethod
     def randomly_update_related_links(cls,  iteration, recent=False):
@@ -767,48 +1491,76 @@ class WikiPage(models.Model, PageOperationMixin):
         else:
             titles = WikiPage.get_titles()
 
+        titles = list(titles)
         if len(titles) > iteration:
             titles = random.sample(titles, iteration)
 
-        pages = [cls.get_by_title(title, follow_redirect=True) for title in titles]
-        for p in pages:
-            if p.update_related_links():
-                p.save()
-
+        # share the budget among sampled pages instead of loading the whole link graph
+        if titles:
+            cls.update_related_links_locally(titles, max(wiki_settings.RELATED_LINKS_PUSH_BUDGET / len(titles), 1))
         return titles
 
     @classmethod
-    def _update_related_links(cls, start_page, page, score, score_table, distance):
-        if distance == 0:
-            return False
-
-        #if l != start_page.title
-        nested_links = [l for l in page.outlinks.values()]
-        links = reduce(lambda a, b: a + b, nested_links, [])
-        links = [l for l in links if l != start_page.title]
-        if len(links) == 0:
-            return False
+    def load_link_graph(cls):
+        return related.LinkGraph(WikiPageLink.objects.filter(public=True).values_list('source', 'target').iterator())
 
-        next_page = WikiPage.get_by_title(random.choice(links), follow_redirect=True)
-        next_link = next_page.title
-        if next_link not in score_table:
-            score_table[next_link] = 0.0
-
-        next_score = score * 0.5
-        score_table[next_link] = next_score
+    @classmethod
+    def update_related_links_of(cls, titles=None, graph=None, **kwargs):
+        """Compute related links of pages by personalized PageRank over the whole link graph and
+        store changed ones. All existing pages are updated if titles is None. Used by the
+        update_related_links command, while pages in requests are updated locally.
+        Returns {title: related_links} of updated pages"""
+        if graph is None:
+            graph = cls.load_link_graph()
+        return cls._store_related_links(titles, lambda title: related.related_links(graph, title, **kwargs))
 
-        # update target page's relate links
-        if next_page.revision > 0:
-            if start_page.title not in next_page.related_links:
-                next_page.related_links[start_page.title] = 0.0
+    @classmethod
+    def update_related_links_locally(cls, titles, max_pushes):
+        """Compute related links of pages by approximate personalized PageRank which only visits
+        neighbourhood of each page. Returns {title: related_links} of updated pages"""
+        return cls._store_related_links(
+            titles, lambda title: related.push_related_links(cls._link_neighbours, title, max_pushes=max_pushes))
 
-            next_page_score = next_score
-            next_page.related_links[start_page.title] += next_page_score
-            next_page.normalize_related_links()
-            next_page.save()
+    @classmethod
+    def _link_neighbours(cls, titles):
+        neighbours = dict((title, set()) for title in titles)
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            batch = titles[i:i + SchemaDataIndex.batch_size]
+            links = WikiPageLink.objects.filter(Q(source__in=batch) | Q(target__in=batch), public=True)
+            for source, target in links.values_list('source', 'target'):
+                if source in neighbours and source != target:
+                    neighbours[source].add(target)
+                if target in neighbours and source != target:
+                    neighbours[target].add(source)
+        return dict((title, list(n)) for title, n in neighbours.items())
 
-        cls._update_related_links(start_page, next_page, next_score, score_table, distance - 1)
-        return True
+    @classmethod
+    def _store_related_links(cls, titles, compute):
+        pages = WikiPage.objects.filter(revision__gt=0).only('id', 'title', '_related_links')
+        if titles is None:
+            pages = pages.iterator()
+        else:
+            titles = list(set(titles))
+            pages = [p for i in range(0, len(titles), SchemaDataIndex.batch_size)
+                     for p in pages.filter(title__in=titles[i:i + SchemaDataIndex.batch_size])]
+
+        updated = {}
+        with transaction.atomic():
+            for page in pages:
+                new_links = compute(page.title)
+                if new_links == page.related_links:
+                    continue
+                WikiPage.objects.filter(id=page.id).update(_related_links=new_links)
+                updated[page.title] = new_links
+            Title.ids_of(chain(updated.keys(), *updated.values()))
+
+        loaded = cls._loaded_pages()
+        for title, links in updated.items():
+            if title in loaded:
+                loaded[title].related_links = links
+        WikiPage._invalidate_rendered(updated.keys())
+        LinkScoreTable.invalidate(updated.keys())
+        return updated
 
     @classmethod
     def get_index(cls, user=None):
@@ -841,61 +1593,67 @@ class WikiPage(models.Model, PageOperationMixin):
         return [page for page in pages if page.can_read(user, default_permission)]
 
     @classmethod
-    def wikiquery(cls, q, user=None):
-        email = user.email if (user is not None and not user.is_anonymous()) else 'None'
-        results = caching.get_wikiquery(q, email)
-        if results is None:
-            page_query, attrs, sort_criteria = search.parse_wikiquery(q)
-            titles = cls._evaluate_pages(page_query)
-            accessible_titles = sorted(WikiPage.get_titles(user).intersection(titles))
-
-            # evaluate
-            results = []
-            if attrs == [u'name']:
-                results += [{u'name': title} for title in accessible_titles]
-            else:
-                for title in accessible_titles:
-                    pagedata = WikiPage.get_by_title(title, follow_redirect=True).data
-                    results.append(OrderedDict((attr, pagedata[attr] if attr in pagedata else None) for attr in attrs))
-
-            # sort: only use first criterion
-            if len(sort_criteria) > 0:
-                criterion = sort_criteria[0][0]
-                descending = sort_criteria[0][1] == '-'
-                results = sorted(results, key=lambda r: r[criterion].pvalue, reverse=descending)
-
-            if len(results) == 1:
-                results = results[0]
+    def get_orphans(cls, user, index=0, count=50):
+        pages = WikiPage.objects.filter(title__in=PageLinkStat.orphans(index, count)).order_by('title')
+        default_permission = WikiPage.get_default_permission()
+        return [page for page in pages if page.can_read(user, default_permission)]
 
-            caching.set_wikiquery(q, email, results)
-        return results
+    @classmethod
+    def get_wanted(cls, index=0, count=50):
+        return PageLinkStat.wanted(index, count)
 
     @classmethod
-    def _evaluate_pages(cls, q):
-        if len(q) == 1:
-            pages = cls._evaluate_pages(q[0])
-        elif len(q) == 2:
-            pages = cls._evaluate_page_query_term(q[0], q[1])
-        else:
-            pages = cls._evaluate_page_query_expr(q[0], q[1], q[2:])
-        return pages
+    def wikiquery_titles(cls, q, user=None, limit=None):
+        """Returns titles of accessible pages matching wikiquery q, in the order of results.
+        If limit is given, only first limit titles are read from the database"""
+        if limit is not None:
+            limit = max(limit, 0)
+        plan = WikiqueryPlan.get(q)
+        accessible = WikiPage.get_titles(user)
+        if not plan.sorted_in_db:
+            return cls._sort_wikiquery_titles(plan, [t for t in plan.sorted_titles() if t in accessible])[:limit]
+
+        # read more while some of titles are not accessible
+        titles = []
+        offset = 0
+        while True:
+            count = None if limit is None else limit - len(titles)
+            batch = plan.sorted_titles(offset, count)
+            titles += [title for title in batch if title in accessible]
+            if count is None or len(batch) < count or len(titles) >= limit:
+                return titles
+            offset += len(batch)
 
     @classmethod
-    def _evaluate_page_query_term(cls, name, value):
-        if name == 'schema' and value.find('/') == -1:
-            value = schema.get_itemtype_path(value)
-        return SchemaDataIndex.query_titles(name, value)
+    def _sort_wikiquery_titles(cls, plan, titles):
+        """Sort by values of pages when some sort criteria are not indexed"""
+        attrs = [attr for attr, _ in plan.sort_criteria]
+        data = plan.data_of(titles, attrs)
+
+        # stable sort from the last criterion. pages without values come last
+        for attr, order in reversed(plan.sort_criteria):
+            present = [title for title in titles if data[title].get(attr) is not None]
+            missing = [title for title in titles if data[title].get(attr) is None]
+            present.sort(key=lambda title: WikiqueryPlan.sort_key(data[title][attr]), reverse=order == '-')
+            titles = present + missing
+        return titles
 
     @classmethod
-    def _evaluate_page_query_expr(cls, operand, op, rest):
-        pages1 = cls._evaluate_pages(operand)
-        pages2 = cls._evaluate_pages(rest)
+    def iter_wikiquery(cls, q, titles):
+        """Yields results of wikiquery q for titles returned by wikiquery_titles, or a slice of them.
+        Values are read in batches so that only a batch of results is held in memory"""
+        plan = WikiqueryPlan.get(q)
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            batch = titles[i:i + SchemaDataIndex.batch_size]
+            if plan.attrs == [u'name']:
+                for title in batch:
+                    yield {u'name': title}
+                continue
 
-        if op == '*':
-            return set(pages1).intersection(pages2)
-        elif op == '+':
-            return set(pages1).union(pages2)
-        raise ValueError('Invalid operator: %s' % op)
+            data = plan.data_of(batch, plan.attrs)
+            for title in batch:
+                pagedata = data[title]
+                yield OrderedDict((attr, pagedata[attr] if attr in pagedata else None) for attr in plan.attrs)
 
     @classmethod
     def get_by_path(cls, path, follow_redirect=False):
@@ -909,32 +1667,78 @@ class WikiPage(models.Model, PageOperationMixin):
         if title[0] == u'=':
             raise ValueError(u'WikiPage title cannot starts with "="')
 
-        try:
-            page = WikiPage.objects.get(title=title)
-        except WikiPage.DoesNotExist:
-            page = None
+        if follow_redirect:
+            title = PageRedirect.resolve(title)
 
-        if page is None:
-            page = WikiPage(title=title, body=u'', revision=0)
-        elif follow_redirect:
-            page = cls._follow_redirect(page)
+        pages = cls._loaded_pages()
+        if title in pages:
+            page = pages[title]
+        else:
+            try:
+                page = WikiPage.objects.get(title=title)
+            except WikiPage.DoesNotExist:
+                page = WikiPage(title=title, body=u'', revision=0)
+            pages[title] = page
 
         return page
 
     @classmethod
-    def _follow_redirect(cls, page, new_redir=None):
-        trail = {page.title}
+    def prefetch(cls, titles):
+        """Load pages of titles into the identity map with a single query per batch"""
+        if getattr(_identity_map, 'pages', None) is None:
+            return
 
-        while new_redir or ('redirect' in page.metadata):
-            next_title = new_redir or page.metadata['redirect']
+        pages = cls._loaded_pages()
+        titles = [t for t in set(titles) if t and t not in pages]
+        for i in range(0, len(titles), SchemaDataIndex.batch_size):
+            for page in WikiPage.objects.filter(title__in=titles[i:i + SchemaDataIndex.batch_size]):
+                pages[page.title] = page
+        for title in titles:
+            if title not in pages and title[0] != u'=':
+                pages[title] = WikiPage(title=title, body=u'', revision=0)
 
-            # set it None to make it work just one time
-            new_redir = None
+    @classmethod
+    def open_identity_map(cls):
+        """Make get_by_title return the same instance for a title until the map is closed.
+        Calls can be nested. Pages are shared only within the current thread"""
+        _identity_map.depth = getattr(_identity_map, 'depth', 0) + 1
+        if _identity_map.depth == 1:
+            _identity_map.pages = {}
+            _identity_map.redirects = {}
 
-            if next_title in trail:
-                raise ValueError('Circular redirection detected')
-            page = cls.get_by_title(next_title)
-        return page
+    @classmethod
+    def close_identity_map(cls):
+        _identity_map.depth -= 1
+        if _identity_map.depth == 0:
+            _identity_map.pages = None
+            _identity_map.redirects = None
+
+    @classmethod
+    def discard_identity_map(cls):
+        """Close identity map regardless of nesting"""
+        _identity_map.depth = 0
+        _identity_map.pages = None
+        _identity_map.redirects = None
+
+    @classmethod
+    @contextmanager
+    def identity_map(cls):
+        cls.open_identity_map()
+        try:
+            yield
+        finally:
+            cls.close_identity_map()
+
+    @classmethod
+    def _loaded_pages(cls):
+        pages = getattr(_identity_map, 'pages', None)
+        # without an open map nothing is kept
+        return pages if pages is not None else {}
+
+    @classmethod
+    def _identical(cls, page):
+        """Return the instance in the identity map which represents the same page"""
+        return cls._loaded_pages().setdefault(page.title, page)
 
     @classmethod
     def similar_titles(cls, titles, target):
@@ -981,41 +1785,6 @@ class WikiPage(models.Model, PageOperationMixin):
             'write': ['login'],
         }
 
-    @staticmethod
-    def _add_inout_links(links, titles, rel):
-        if len(titles) == 0:
-            return
-        if rel not in links:
-            links[rel] = []
-        links[rel] += titles
-        links[rel].sort()
-
-    @staticmethod
-    def _add_inout_link(links, title, rel):
-        WikiPage._add_inout_links(links, [title], rel)
-
-    @staticmethod
-    def _del_inout_link(links, title, rel=None):
-        if rel in links:
-            try:
-                links[rel].remove(title)
-            except ValueError:
-                pass
-            except KeyError:
-                pass
-
-            if len(links[rel]) == 0:
-                del links[rel]
-        else:
-            for rel, titles in links.items():
-                try:
-                    titles.remove(title)
-                except ValueError:
-                    pass
-
-                if len(titles) == 0:
-                    del links[rel]
-
 
 class WikiPageRevision(models.Model, PageOperationMixin):
     title = models.CharField(max_length=255)
@@ -1028,6 +1797,11 @@ class WikiPageRevision(models.Model, PageOperationMixin):
     acl_write = models.CharField(max_length=255)
     created_at = models.DateTimeField()
 
+    class Meta:
+        index_together = [
+            ('title', 'revision'),
+        ]
+
     def __str__(self):
         return self.title + ' : ' + str(self.revision)
 
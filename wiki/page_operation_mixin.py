@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import re
 import yaml
+import hashlib
 import operator
+import Queue
 import urllib2
 import schema
 from collections import OrderedDict
@@ -15,29 +17,65 @@ from markdownext import md_url, md_wikilink, md_itemprop, md_mathjax, md_striket
     md_section, md_embed
 from utils import merge_dicts, pairs_to_dict
 from toc_generator import TocGenerator
+import caching
 import acl
+import wiki_settings
+
+
+def create_markdown():
+    return markdown.Markdown(
+        extensions=[
+            md_wikilink.WikiLinkExtension(),
+            md_itemprop.ItemPropExtension(),
+            md_url.URLExtension(),
+            md_mathjax.MathJaxExtension(),
+            md_strikethrough.StrikethroughExtension(),
+            md_partials.PartialsExtension(),
+            md_tables.TableExtension(),
+            md_section.SectionExtension(),
+            md_embed.EmbedExtension(),
+            DefListExtension(),
+            AttrListExtension(),
+        ],
+        safe_mode=False,
+        smart_emphasis=False,
+    )
+
+
+class MarkdownPool(object):
+    """Pool of prebuilt Markdown instances which can be used by concurrent threads.
+
+    An instance is checked out for a single conversion and reset before it is
+    returned, so no state leaks between renders. When every instance is busy a
+    new one is built and dropped afterwards if the pool is already full.
+    """
+    def __init__(self, size):
+        self._pool = Queue.Queue(size)
+        for _ in range(size):
+            self._pool.put(create_markdown())
+
+    def convert(self, text):
+        try:
+            renderer = self._pool.get_nowait()
+        except Queue.Empty:
+            renderer = create_markdown()
+
+        try:
+            return renderer.convert(text)
+        finally:
+            renderer.reset()
+            try:
+                self._pool.put_nowait(renderer)
+            except Queue.Full:
+                pass
 
-md = markdown.Markdown(
-    extensions=[
-        md_wikilink.WikiLinkExtension(),
-        md_itemprop.ItemPropExtension(),
-        md_url.URLExtension(),
-        md_mathjax.MathJaxExtension(),
-        md_strikethrough.StrikethroughExtension(),
-        md_partials.PartialsExtension(),
-        md_tables.TableExtension(),
-        md_section.SectionExtension(),
-        md_embed.EmbedExtension(),
-        DefListExtension(),
-        AttrListExtension(),
-    ],
-    safe_mode=False,
-    smart_emphasis=False,
-)
+
+md = MarkdownPool(wiki_settings.MARKDOWN_POOL_SIZE)
 
 
 class PageOperationMixin(object):
     re_img = re.compile(ur'<(.+?)>[\n\t\s]*<img( .+? )/>[\n\t\s]*</(.+?)>')
+    re_hashbang = re.compile(ur'<code>#!(.+?)[\n;]')
     re_metadata = re.compile(ur'^\.([^\s]+)(\s+(.+))?$')
     re_data = re.compile(ur'({{|\[\[)(?P<name>[^\]}]+)::(?P<value>[^\]}]+)(}}|\]\])')
     re_section_data = re.compile(ur'''^(?P<name>[^\s]+?)::---+$''')
@@ -60,6 +98,8 @@ class PageOperationMixin(object):
                                          ur'April|May|June|July|August|'
                                          ur'September|October|November|'
                                          ur'December)( (?P<date>[0123]?\d))?)$')
+    re_block_boundary = re.compile(ur'\n[ \t]*\n(?=#)')
+    re_unsplittable = re.compile(ur'^(<|[ ]{0,3}\[[^\]]+\]:|[^\s]+?::---+$)', re.MULTILINE)
 
     def __init__(self):
         self.cur_user = None
@@ -469,11 +509,55 @@ class PageOperationMixin(object):
 
     @staticmethod
     def extract_hashbangs(html):
-        matches = re.findall(ur'<code>#!(.+?)[\n;]', html)
-        if re.match(ur'.*(\\\(.+\\\)|\$\$.+\$\$)', html, re.DOTALL):
+        matches = re.findall(PageOperationMixin.re_hashbang, html)
+        if PageOperationMixin.has_mathjax(html):
             matches.append('mathjax')
         return matches
 
+    @staticmethod
+    def has_mathjax(html):
+        # same as matching `\\(.+\\)` or `\$\$.+\$\$` without scanning html over and over
+        for begin, end in ((u'\\(', u'\\)'), (u'$$', u'$$')):
+            index = html.find(begin)
+            if index != -1 and html.find(end, index + len(begin) + 1) != -1:
+                return True
+        return False
+
+    @classmethod
+    def render_markdown(cls, text):
+        """Render markdown text to sanitized html block by block, reusing cached html of unchanged blocks"""
+        # raw html, reference definitions and sections may span headings
+        if re.search(cls.re_unsplittable, text):
+            return cls._render_block(text)
+
+        blocks = [(cls.block_key(block), block) for block in re.split(cls.re_block_boundary, text)]
+        cached = caching.get_rendered_blocks([key for key, _ in blocks])
+
+        rendered = []
+        missed = {}
+        for key, block in blocks:
+            html = cached.get(key, missed.get(key))
+            if html is None:
+                html = missed[key] = cls._render_block(block)
+            if html:
+                rendered.append(html)
+        caching.set_rendered_blocks(missed)
+        return u'\n'.join(rendered)
+
+    @staticmethod
+    def block_key(block):
+        """Cache key of rendered block. Renderer changes with VERSION, so does the key"""
+        return hashlib.md5((wiki_settings.VERSION + u':' + block).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _render_block(cls, text):
+        rendered = md.convert(text)
+
+        # add class for embedded image
+        rendered = PageOperationMixin.re_img.sub(ur'<\1 class="img-container"><img\2/></\3>', rendered)
+
+        return cls.sanitize_html(u'<div>%s</div>' % rendered) if rendered else rendered
+
     @classmethod
     def render_body(cls, title, body, rendered_data='', inlinks={}, related_links_by_score={}, older_title=None, newer_title=None):
         # body
@@ -498,8 +582,8 @@ class PageOperationMixin(object):
             lines = [u'# Suggested Pages']
             lines += [u'* {{.score::%.3f}} [[%s]]\n{.noli}' % (score, t)
                       for t, score in related_links.items()[:10]]
+            lines.append(u'* [More suggestions...](/+%s)\n{.more-suggestions}' % (cls.title_to_path(title)))
             body_parts.append(u'\n'.join(lines))
-            body_parts.append(u'* [More suggestions...](/+%s)\n{.more-suggestions}' % (cls.title_to_path(title)))
 
         # other posts
         if older_title or newer_title:
@@ -511,18 +595,16 @@ class PageOperationMixin(object):
             body_parts.append(u'\n'.join(lines))
 
         # remove yaml/schema block
-        joined = u'\n'.join(body_parts)
+        joined = u'\n\n'.join(body_parts)
         joined = re.sub(PageOperationMixin.re_yaml_schema, u'\n', joined)
 
-        # render to html
-        rendered = md.convert(joined)
+        # render to sanitized html
+        rendered = cls.render_markdown(joined)
 
         # add table of contents
         rendered = TocGenerator(rendered).add_toc()
 
-        # add class for embedded image
-        rendered = PageOperationMixin.re_img.sub(ur'<\1 class="img-container"><img\2/></\3>', rendered)
-
         # add structured data block
-        rendered = rendered_data + rendered
-        return cls.sanitize_html(rendered)
\ No newline at end of file
+        if rendered_data:
+            rendered = cls.sanitize_html(u'<div>%s</div>' % rendered_data) + rendered
+        return rendered
\ No newline at end of file
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import heapq
+import operator
+from collections import deque
+
+
+class LinkGraph(object):
+    """Undirected link graph of pages. Nodes are numbered and adjacency holds lists of neighbour numbers"""
+    def __init__(self, links):
+        self.titles = []
+        self.index = {}
+        neighbours = []
+        for source, target in links:
+            if source == target:
+                continue
+            s = self._node(source, neighbours)
+            t = self._node(target, neighbours)
+            neighbours[s].add(t)
+            neighbours[t].add(s)
+        self.adjacency = [list(n) for n in neighbours]
+
+    def __contains__(self, title):
+        return title in self.index
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _node(self, title, neighbours):
+        node = self.index.get(title)
+        if node is None:
+            node = self.index[title] = len(self.titles)
+            self.titles.append(title)
+            neighbours.append(set())
+        return node
+
+    def neighbours(self, title):
+        return [self.titles[n] for n in self.adjacency[self.index[title]]]
+
+
+def personalized_pagerank(adjacency, source, restart=0.15, iterations=20, tolerance=1e-4):
+    """Random walk with restart from source by power iteration over a sparse score vector.
+    Scores below tolerance are dropped so that work is bounded by the reachable neighbourhood"""
+    scores = {source: 1.0}
+    for _ in range(iterations):
+        next_scores = {source: restart}
+        for node, score in scores.iteritems():
+            neighbours = adjacency[node]
+            if len(neighbours) == 0:
+                next_scores[source] += (1.0 - restart) * score
+                continue
+            share = (1.0 - restart) * score / len(neighbours)
+            if share < tolerance:
+                continue
+            for n in neighbours:
+                next_scores[n] = next_scores.get(n, 0.0) + share
+
+        delta = sum(abs(next_scores.get(n, 0.0) - scores.get(n, 0.0)) for n in set(scores).union(next_scores))
+        scores = next_scores
+        if delta < tolerance:
+            break
+    return scores
+
+
+def push_pagerank(load_neighbours, source, restart=0.15, epsilon=1e-3, max_pushes=200):
+    """Approximate personalized PageRank from source by pushing residual scores to neighbours.
+    Only the neighbourhood around source is visited and at most max_pushes nodes are pushed.
+    load_neighbours takes a list of titles and returns {title: neighbour titles} of them"""
+    estimate = {}
+    residual = {source: 1.0}
+    neighbours = {}
+    queue = deque([source])
+    queued = {source}
+    pushes = 0
+
+    while queue and pushes < max_pushes:
+        node = queue.popleft()
+        queued.discard(node)
+        if node not in neighbours:
+            # load neighbours of waiting nodes too, to keep the number of loads small
+            missing = [node] + [n for n in queue if n not in neighbours]
+            loaded = load_neighbours(missing)
+            for n in missing:
+                neighbours[n] = loaded.get(n, [])
+
+        links = neighbours[node]
+        score = residual.get(node, 0.0)
+        if score < epsilon * max(len(links), 1):
+            continue
+
+        pushes += 1
+        estimate[node] = estimate.get(node, 0.0) + restart * score
+        residual[node] = 0.0
+        targets = links if links else [source]
+        share = (1.0 - restart) * score / len(targets)
+        for n in targets:
+            residual[n] = residual.get(n, 0.0) + share
+            if n not in queued:
+                queue.append(n)
+                queued.add(n)
+
+    return estimate, neighbours.get(source, [])
+
+
+def push_related_links(load_neighbours, title, count=30, **kwargs):
+    """Same as related_links but approximated locally without loading the whole graph"""
+    scores, direct = push_pagerank(load_neighbours, title, **kwargs)
+    return _top(scores.iteritems(), set(direct).union([title]), count)
+
+
+def related_links(graph, title, count=30, **kwargs):
+    """Return {title: score} of at most count pages related to title. Title itself and
+    directly linked pages are excluded since they are shown as links already"""
+    if title not in graph:
+        return {}
+
+    source = graph.index[title]
+    scores = personalized_pagerank(graph.adjacency, source, **kwargs)
+    return _top(((graph.titles[n], s) for n, s in scores.iteritems()),
+                set(graph.neighbours(title)).union([title]), count)
+
+
+def _top(scores, excluded, count):
+    candidates = ((t, s) for t, s in scores if t not in excluded)
+    return dict(heapq.nlargest(count, candidates, key=operator.itemgetter(1)))
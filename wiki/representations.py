@@ -1,4 +1,6 @@
 import json
+from itertools import chain
+from django.http import StreamingHttpResponse
 from django.template import RequestContext, loader
 from models import WikiPage
 import wiki_settings
@@ -56,6 +58,28 @@ class JsonRepresentation(Representation):
         return self._respond(httpres, head, self._content_type, json.dumps(self._content))
 
 
+class StreamingRepresentation(Representation):
+    """Content is an iterable of unicode chunks which are sent as soon as they are made"""
+    def respond(self, httpres, head):
+        if head:
+            httpres['Content-type'] = self._content_type
+            return httpres
+        chunks = (chunk.encode('utf-8') for chunk in self._content)
+        return StreamingHttpResponse(chunks, content_type=self._content_type)
+
+
+class StreamingTemplateRepresentation(TemplateRepresentation):
+    """Same as TemplateRepresentation but content['body'] is an iterable of unicode chunks
+    streamed in place of the body"""
+    marker = u'<!-- body -->'
+
+    def respond(self, httpres, head):
+        content = dict(self._content, body=self.marker)
+        before, after = template(self._httpreq, self._template_path, content).split(self.marker, 1)
+        chunks = chain([before], self._content['body'], [after])
+        return StreamingRepresentation(chunks, self._content_type).respond(httpres, head)
+
+
 def template(req, path, data):
     config = WikiPage.get_config()
     t = loader.get_template('wiki/%s' % path)
@@ -1,23 +1,55 @@
 # coding=utf-8
 import json
+import base64
 import urllib2
-import operator
-from itertools import groupby
+from itertools import groupby, chain
 from collections import OrderedDict
 from pyatom import AtomFeed
 from models import WikiPage, UserPreferences, ConflictError
 from django.http import HttpResponse, HttpResponseRedirect
+from django.utils.http import urlquote
 from representations import Representation, TemplateRepresentation, EmptyRepresentation, JsonRepresentation, template
+from representations import StreamingRepresentation, StreamingTemplateRepresentation
 from .templatetags.wiki_extras import format_iso_datetime
 from utils import title_grouper
-import caching
 import search
 import schema
+import wiki_settings
 
 def get_restype(req, default):
     return str(req.GET.get('_type', default))
 
 
+def encode_cursor(offset, title):
+    return base64.urlsafe_b64encode(json.dumps([offset, title]))
+
+
+def decode_cursor(cursor):
+    try:
+        offset, title = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        offset = max(0, int(offset))
+    except TypeError:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return offset, title
+
+
+def cursor_offset(titles, offset, title):
+    """Returns offset of the result next to a cursor. If pages were added or removed before it,
+    the position of the last title of previous results is looked up again"""
+    if 0 < offset <= len(titles) and titles[offset - 1] == title:
+        return offset
+    elif title in titles:
+        return titles.index(title) + 1
+    else:
+        return offset
+
+
+def raw_value(o):
+    if isinstance(o, schema.Property):
+        return o.pvalue
+    raise TypeError('%r is not JSON serializable' % o)
+
+
 class Resource(object):
     def __init__(self, req, default_restype='html', default_view='default'):
         self.req = req
@@ -128,8 +160,6 @@ class PageLikeResource(Resource):
 
 class PageResource(PageLikeResource):
     def load(self):
-        if self.req.user and not self.req.user.is_anonymous():
-            caching.add_recent_email(self.req.user.email)
         page = WikiPage.get_by_path(self.path)
         page.set_cur_user(self.req.user)
         return page
@@ -285,6 +315,44 @@ class ChangeListResource(Resource):
         return TemplateRepresentation(data, self.req, 'sp_changes_bodyonly.html')
 
 
+class OrphanListResource(Resource):
+    def load(self):
+        index = int(self.req.GET.get('index', '0'))
+        count = min(50, int(self.req.GET.get('count', '50')))
+        return {
+            'cur_index': index,
+            'next_index': index + 1,
+            'count': count,
+            'pages': WikiPage.get_orphans(self.req.user, index, count),
+        }
+
+    def represent_html_default(self, data):
+        return TemplateRepresentation(data, self.req, 'sp_orphans.html')
+
+    def represent_json_default(self, data):
+        return JsonRepresentation([page.title for page in data['pages']])
+
+
+class WantedListResource(Resource):
+    def load(self):
+        index = int(self.req.GET.get('index', '0'))
+        count = min(50, int(self.req.GET.get('count', '50')))
+        return {
+            'cur_index': index,
+            'next_index': index + 1,
+            'count': count,
+            'titles': WikiPage.get_wanted(index, count),
+        }
+
+    def represent_html_default(self, data):
+        data['titles'] = [(WikiPage.title_to_path(title), title, inlink_count)
+                          for title, inlink_count in data['titles']]
+        return TemplateRepresentation(data, self.req, 'sp_wanted.html')
+
+    def represent_json_default(self, data):
+        return JsonRepresentation(OrderedDict(data['titles']))
+
+
 class TitleIndexResource(Resource):
     def load(self):
         return WikiPage.get_index(self.req.user)
@@ -495,16 +563,10 @@ class RelatedPagesResource(Resource):
 
     def load(self):
         expression = WikiPage.path_to_title(self.path)
-        scoretable = WikiPage.search(expression)
+        scoretable = WikiPage.search(expression, 20)
         parsed_expression = search.parse_expression(expression)
-        positives = dict([(k, v) for k, v in scoretable.items() if v >= 0.0])
-        positives = OrderedDict(sorted(positives.iteritems(),
-                                       key=operator.itemgetter(1),
-                                       reverse=True)[:20])
-        negatives = dict([(k, abs(v)) for k, v in scoretable.items() if v < 0.0])
-        negatives = OrderedDict(sorted(negatives.iteritems(),
-                                       key=operator.itemgetter(1),
-                                       reverse=True)[:20])
+        positives = OrderedDict((k, v) for k, v in scoretable.items() if v >= 0.0)
+        negatives = OrderedDict((k, abs(v)) for k, v in reversed(scoretable.items()) if v < 0.0)
         context =  {
             'expression': expression,
             'parsed_expression': parsed_expression,
@@ -531,27 +593,70 @@ class WikiqueryResource(Resource):
 
     def load(self):
         query = WikiPage.path_to_title(self.path)
+        limit = max(1, min(wiki_settings.WIKIQUERY_MAX_PAGE_SIZE,
+                           int(self.req.GET.get('limit', wiki_settings.WIKIQUERY_PAGE_SIZE))))
+        if 'cursor' in self.req.GET:
+            offset, last_title = decode_cursor(self.req.GET['cursor'])
+        else:
+            offset, last_title = max(0, int(self.req.GET.get('offset', '0'))), None
+
+        # read one more title to know whether there are more results
+        titles = WikiPage.wikiquery_titles(query, self.req.user, offset + limit + 1)
+        if last_title is not None and cursor_offset(titles, offset, last_title) != offset:
+            offset = cursor_offset(titles, offset, last_title)
+            titles = WikiPage.wikiquery_titles(query, self.req.user, offset + limit + 1)
+        page = titles[offset:offset + limit]
+        next_offset = offset + len(page)
+
         return {
-            'result': WikiPage.wikiquery(query, self.req.user),
-            'query': query
+            'result': WikiPage.iter_wikiquery(query, page),
+            'query': query,
+            'single': len(titles) == 1 and len(page) == 1,
+            'limit': limit,
+            'next': encode_cursor(next_offset, page[-1]) if page and next_offset < len(titles) else None,
         }
 
     def represent_html_default(self, content):
         content = {
             'title': content['query'],
-            'body': schema.to_html(content['result']),
+            'body': self._iter_html(content),
         }
-        return TemplateRepresentation(content, self.req, 'generic.html')
+        return StreamingTemplateRepresentation(content, self.req, 'generic.html')
 
     def represent_html_bodyonly(self, content):
         content = {
             'title': u'Search: %s ' % content['query'],
-            'body': schema.to_html(content['result']),
+            'body': self._iter_html(content),
         }
-        return TemplateRepresentation(content, self.req, 'generic_bodyonly.html')
+        return StreamingTemplateRepresentation(content, self.req, 'generic_bodyonly.html')
 
     def represent_json_default(self, content):
-        return JsonRepresentation(content)
+        return StreamingRepresentation(self._iter_json(content), 'application/json; charset=utf-8')
+
+    def _iter_html(self, content):
+        # a single result is shown by itself, not as a list
+        if content['single']:
+            chunks = (schema.to_html(result) for result in content['result'])
+        else:
+            chunks = schema.iter_html(content['result'])
+
+        if content['next'] is None:
+            return chunks
+        url = u'%s?cursor=%s&amp;limit=%d' % (urlquote(self.req.path), content['next'], content['limit'])
+        return chain(chunks, [u'\n<a class="wq-next" href="%s">Next page</a>' % url])
+
+    @staticmethod
+    def _iter_json(content):
+        yield u'{"query": %s, "next": %s, "result": ' % (json.dumps(content['query']), json.dumps(content['next']))
+        if content['single']:
+            for result in content['result']:
+                yield json.dumps(result, default=raw_value)
+        else:
+            yield u'['
+            for i, result in enumerate(content['result']):
+                yield (u', ' if i > 0 else u'') + json.dumps(result, default=raw_value)
+            yield u']'
+        yield u'}'
 
 
 class SchemaResource(Resource):
@@ -47,6 +47,14 @@ def render_list(o):
     )
 
 
+def iter_html(results):
+    """Same as to_html for a list but consumes results lazily and yields chunks of html"""
+    yield u'<ul class="wq wq-list">'
+    for value in results:
+        yield u'\n<li>%s</li>' % to_html(value)
+    yield u'\n</ul>'
+
+
 def get_legacy_spellings():
     schema_set = get_schema_set()
     props = schema_set['properties']
@@ -451,6 +459,15 @@ class Property(object):
     def should_index(self):
         return True
 
+    def to_number(self):
+        """Numeric sort key of the value, or None if the value is not a number"""
+        return None
+
+    def to_number_range(self):
+        """(lowest, highest) numbers of values which the value stands for, or None if it is not a number"""
+        number = self.to_number()
+        return None if number is None else (number, number)
+
     def render(self):
         return self.pvalue
 
@@ -508,6 +525,9 @@ class BooleanProperty(TypeProperty):
         else:
             self.value = False
 
+    def to_number(self):
+        return 1.0 if self.value else 0.0
+
 
 class TextProperty(TypeProperty):
     def __init__(self, itemtype, ptype, pname, pvalue):
@@ -553,6 +573,9 @@ class NumberProperty(TypeProperty):
 
         self.value = pvalue
 
+    def to_number(self):
+        return float(self.value)
+
 
 class IntegerProperty(NumberProperty):
     def __init__(self, itemtype, ptype, pname, pvalue):
@@ -595,6 +618,26 @@ class DateTimeProperty(TypeProperty):
     def is_wikilink(self):
         return False
 
+    def to_number(self):
+        """Same scale as DateProperty.to_number() with the time as a fraction of a day"""
+        for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]:
+            try:
+                dt = datetime.strptime(self.pvalue, fmt)
+            except (TypeError, ValueError):
+                continue
+            seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+            return dt.year * 10000 + dt.month * 100 + dt.day + seconds / 86400.0
+        return None
+
+    def to_number_range(self):
+        """A date without time stands for the whole day"""
+        number = self.to_number()
+        if number is None:
+            return None
+        elif len(self.pvalue) == len("yyyy-mm-dd"):
+            return number, number + 86399 / 86400.0
+        return number, number
+
 
 class TimeProperty(TextProperty):
     # TODO implement this (shouldn't inherit from TextProperty)
@@ -655,6 +698,20 @@ class DateProperty(TypeProperty):
     def is_year_only(self):
         return self.month is None and self.day is None
 
+    def to_number(self):
+        """Date as a number like yyyymmdd. Unknown month or day is 0 and years of BCE are negative"""
+        year = -self.year if self.bce else self.year
+        return float(year * 10000 + (self.month or 0) * 100 + (self.day or 0))
+
+    def to_number_range(self):
+        """A year or a month stands for all days in it"""
+        number = self.to_number()
+        if self.month is None:
+            return number, number + 1299
+        elif self.day is None:
+            return number, number + 99
+        return number, number
+
     def is_wikilink(self):
         return True
 
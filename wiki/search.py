@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import re
+import heapq
 import operator
+from itertools import groupby
 import pyparsing as p
 from collections import OrderedDict
 
@@ -28,29 +30,46 @@ def parse_expression(exp):
     }
 
 
-def evaluate(positives, negatives):
-    """evaluate related page search expression"""
-    scoretable = {}
-    keys = positives.keys() + negatives.keys()
+def evaluate(positives, negatives, k=None):
+    """evaluate related page search expression. Operands and scoretables are keyed by titles or title ids.
+    scoretables are dicts or lists of (key, score) pairs ordered by key.
+    If k is given, only k highest positive and k lowest negative scores are returned"""
+    scores = _merged_scores(positives, negatives)
+    if k is None:
+        return OrderedDict(sorted(scores, key=operator.itemgetter(1), reverse=True))
+
+    # bounded min-heaps of (abs(score), -order, title). earlier title wins a tie
+    pos_heap = []
+    neg_heap = []
+    for order, (title, score) in enumerate(scores):
+        heap = pos_heap if score >= 0 else neg_heap
+        item = (abs(score), -order, title)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    pos = [(title, score) for score, _, title in sorted(pos_heap, reverse=True)]
+    neg = [(title, -score) for score, _, title in sorted(neg_heap)]
+    return OrderedDict(pos + neg)
+
+
+def _merged_scores(positives, negatives):
+    keys = set(positives.keys() + negatives.keys())
     length = len(keys)
 
-    _update_scoretable(keys, length, positives, scoretable, +1)
-    _update_scoretable(keys, length, negatives, scoretable, -1)
-    sorted_tuples = sorted(scoretable.iteritems(),
-                           key=operator.itemgetter(1),
-                           reverse=True)
+    vectors = [_signed_vector(scores, +1) for scores in positives.values()] + \
+              [_signed_vector(scores, -1) for scores in negatives.values()]
+    for title, group in groupby(heapq.merge(*vectors), key=operator.itemgetter(0)):
+        if title in keys:
+            continue
+        yield title, sum(score for _, score in group) / length
 
-    return OrderedDict(sorted_tuples)
 
-
-def _update_scoretable(keys, length, matches, scoretable, sign):
-    for scores in matches.values():
-        for title, score in scores.items():
-            if title in keys:
-                continue
-            if title not in scoretable:
-                scoretable[title] = 0.0
-            scoretable[title] += sign * score / length
+def _signed_vector(scores, sign):
+    if isinstance(scores, dict):
+        scores = sorted(scores.items())
+    return ((title, sign * score) for title, score in scores)
 
 
 # Wikiquery grammar
@@ -64,8 +83,24 @@ sort_expr = p.Forward()
 expr = page_query_expr + p.Optional(p.Suppress('>') + attr_expr)
 expr.setParseAction(lambda x: x if len(x) == 2 else [x[0], [[u'name']]])
 
-page_query_term = p.Group(p.Optional(identifier + p.Suppress(':')) + double_quote_str)
-page_query_term.setParseAction(lambda x: x if len(x[0]) == 2 else [[u'name', x[0][0]]])
+range_op = p.oneOf('> <')
+range_expr = p.Optional(range_op('op')) + double_quote_str('value') + \
+    p.Optional(p.Suppress('..') + double_quote_str('high'))
+
+
+def _page_query_term(tokens):
+    """Returns one of [name, value], [name, '>' or '<', value] and [name, '..', low, high]"""
+    t = tokens[0]
+    name = t.get('name', u'name')
+    if 'high' in t:
+        return [[name, u'..', t['value'], t['high']]]
+    elif 'op' in t:
+        return [[name, t['op'], t['value']]]
+    else:
+        return [[name, t['value']]]
+
+page_query_term = p.Group(p.Optional(identifier('name') + p.Suppress(':')) + range_expr)
+page_query_term.setParseAction(_page_query_term)
 page_query_expr << p.operatorPrecedence(page_query_term, [
     (p.Literal('*'), 2, p.opAssoc.LEFT),
     (p.Literal('+'), 2, p.opAssoc.LEFT),
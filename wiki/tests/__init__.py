@@ -2,7 +2,6 @@ import random
 from django.test import TestCase
 from django.contrib.auth.models import User
 from ..models import WikiPage
-from .. import caching
 
 
 class WikiTestCase(TestCase):
@@ -19,8 +18,6 @@ class WikiTestCase(TestCase):
             else:
                 user = User.objects.create_user(username=username, email='', password=password)
 
-        if user:
-            caching.add_recent_email(user.email)
         page.set_cur_user(user)
         return user
 
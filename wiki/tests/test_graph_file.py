@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from StringIO import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+from . import WikiTestCase
+from .. import graph_file
+from ..models import WikiPage, WikiPageLink, LinkScoreTable, Title
+
+
+class GraphFileTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_write_and_read(self):
+        links = [
+            (u'A', u'B한글', u'Article/relatedTo', True),
+            (u'B한글', u'C', u'Book/author', False),
+            (u'A', u'C', u'Article/relatedTo', True),
+        ]
+        with open(self.path, 'wb') as f:
+            self.assertEqual(3, graph_file.write(f, iter(links)))
+
+        with graph_file.GraphFile(self.path) as graph:
+            self.assertEqual(3, len(graph))
+            self.assertEqual([u'A', u'B한글', u'C'], graph.titles)
+            self.assertEqual([u'Article/relatedTo', u'Book/author'], graph.rels)
+            self.assertEqual(links, list(graph.edges()))
+            self.assertEqual((1, 2, 1, False), graph.edge(1))
+
+    def test_empty(self):
+        with open(self.path, 'wb') as f:
+            graph_file.write(f, iter([]))
+        with graph_file.GraphFile(self.path) as graph:
+            self.assertEqual([], list(graph.edges()))
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('Hello' * 10)
+        self.assertRaises(ValueError, graph_file.GraphFile, self.path)
+
+
+class LinkGraphCommandTest(WikiTestCase):
+    def setUp(self):
+        super(LinkGraphCommandTest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(LinkGraphCommandTest, self).tearDown()
+
+    def test_export_and_import(self):
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.update_page(u'.read 0hoo@0hoo.com\n[[C]]', u'D')
+        expected = set(WikiPageLink.objects.values_list('source', 'target', 'rel', 'public'))
+
+        call_command('link_graph', 'export', self.path, stdout=StringIO())
+        WikiPageLink.objects.all().delete()
+        call_command('link_graph', 'import', self.path, stdout=StringIO())
+
+        self.assertEqual(expected, set(WikiPageLink.objects.values_list('source', 'target', 'rel', 'public')))
+        self.assertEqual({u'Article/relatedTo': [u'A']}, WikiPage.get_by_title(u'C').inlinks)
+
+    def test_imported_titles_have_ids(self):
+        self.update_page(u'Hello', u'A')
+        with open(self.path, 'wb') as f:
+            graph_file.write(f, iter([(u'A', u'Imported', u'Article/relatedTo', True)]))
+        call_command('link_graph', 'import', self.path, stdout=StringIO())
+
+        imported_id = Title.objects.get(title=u'Imported').id
+        vector = LinkScoreTable.vectors_of([WikiPage.get_by_title(u'A')])[u'A']
+        self.assertEqual([imported_id], [title_id for title_id, _ in vector])
@@ -1,4 +1,6 @@
 import re
+import json
+import base64
 import lxml.etree
 from lxml.html import html5parser
 from django.test import Client
@@ -57,4 +59,31 @@ class ContentTypeTest(WikiTestCase):
 
     def test_should_not_restrict_read_access_to_custom_content_type(self):
         p = WikiPage.get_by_title(u'Test')
-        self.assertRaises(ValueError, p.update_content, u'.read ak@gmail.com\n.content-type text/plain\nHello', 0)
\ No newline at end of file
+        self.assertRaises(ValueError, p.update_content, u'.read ak@gmail.com\n.content-type text/plain\nHello', 0)
+
+
+class WikiqueryPaginationTest(WikiTestCase):
+    def setUp(self):
+        super(WikiqueryPaginationTest, self).setUp()
+        for i in range(3):
+            self.update_page(u'.schema Book\nHello', u'Book %d' % i)
+
+    def get_names(self, **params):
+        params['_type'] = 'json'
+        # results are streamed
+        res = self.client.get('/=schema:"Book"', params)
+        return [r['name'] for r in json.loads(''.join(res.streaming_content))['result']]
+
+    def test_limit(self):
+        self.assertEqual([u'Book 0', u'Book 1'], self.get_names(limit='2'))
+
+    def test_zero_limit(self):
+        self.assertEqual([u'Book 0'], self.get_names(limit='0'))
+
+    def test_negative_limit_and_offset(self):
+        self.assertEqual([u'Book 0'], self.get_names(limit='-1'))
+        self.assertEqual([u'Book 0', u'Book 1', u'Book 2'], self.get_names(offset='-2'))
+
+    def test_negative_offset_in_cursor(self):
+        cursor = base64.urlsafe_b64encode(json.dumps([-2, u'Book 9']))
+        self.assertEqual([u'Book 0', u'Book 1', u'Book 2'], self.get_names(cursor=cursor))
@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
+import re
+import threading
 from itertools import groupby
+from StringIO import StringIO
 from django.core.cache import cache
-from ..models import WikiPage, PageOperationMixin, UserPreferences
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from ..models import WikiPage, PageOperationMixin, UserPreferences, RenderedPage, WikiPageLink, LinkJob, LinkScoreTable, \
+    Title, PageLinkStat, PageRedirect
+from ..page_operation_mixin import md, MarkdownPool
 from . import WikiTestCase
 from ..markdownext.md_wikilink import parse_wikilinks
+from ..management.commands import migrate_links
 from ..utils import title_grouper
 from .. import wiki_settings
+from .. import caching
 
 
 class PageUpdateTest(WikiTestCase):
@@ -226,10 +237,56 @@ class RelatedPageUpdatingTest(WikiTestCase):
         page = self.update_page(u'[[B]]', u'A')
         self.update_page(u'[[C]]', u'B')
         self.update_page(u'[[D]]', u'C')
-        page.update_related_links()
-        page.save()
+        self.assertTrue(page.update_related_links())
+
+        self.assertEqual({u'C', u'D'}, set(page.related_links.keys()))
+        self.assertTrue(page.related_links[u'C'] > page.related_links[u'D'])
+        self.assertEqual(page.related_links, WikiPage.objects.get(title=u'A').related_links)
+
+    def test_update_all_related_links(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'[[B]]', u'C')
+        self.update_page(u'Hello', u'B')
 
-        self.assertEqual({u'C': 0.025, u'D': 0.0125}, page.related_links)
+        updated = WikiPage.update_related_links_of()
+        self.assertEqual({u'A', u'C'}, set(updated.keys()))
+        self.assertEqual([u'C'], WikiPage.get_by_title(u'A').related_links.keys())
+        self.assertEqual([u'A'], WikiPage.get_by_title(u'C').related_links.keys())
+        self.assertEqual({}, WikiPage.update_related_links_of())
+
+    def test_restricted_links_are_not_used(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'.read 0hoo@0hoo.com\n[[B]]', u'C')
+        WikiPage.update_related_links_of()
+        self.assertEqual({}, WikiPage.get_by_title(u'A').related_links)
+
+    def test_incremental_update(self):
+        wiki_settings.INCREMENTAL_RELATED_LINKS = True
+        try:
+            self.update_page(u'Hello', u'C')
+            self.update_page(u'[[B]]', u'A')
+            self.update_page(u'[[C]]', u'B')
+        finally:
+            wiki_settings.INCREMENTAL_RELATED_LINKS = False
+
+        self.assertEqual([u'C'], WikiPage.get_by_title(u'A').related_links.keys())
+        self.assertEqual([u'A'], WikiPage.get_by_title(u'C').related_links.keys())
+
+    def test_random_update_does_not_load_whole_graph(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'[[C]]', u'B')
+        self.update_page(u'Hello', u'C')
+
+        def fail():
+            raise AssertionError('whole graph loaded')
+        load_link_graph = WikiPage.load_link_graph
+        WikiPage.load_link_graph = staticmethod(fail)
+        try:
+            self.assertEqual({u'A', u'B', u'C'}, set(WikiPage.randomly_update_related_links(50)))
+            self.assertTrue(WikiPage.get_by_title(u'A').update_related_links() is not None)
+        finally:
+            WikiPage.load_link_graph = load_link_graph
+        self.assertEqual([u'C'], WikiPage.get_by_title(u'A').related_links.keys())
 
     def test_redirect(self):
         page = self.update_page(u'[[B]]', u'A')
@@ -406,6 +463,75 @@ class RedirectionTest(WikiTestCase):
         self.update_page(u'.redirect C', u'B')
         self.assertRaises(ValueError, self.update_page, u'.redirect A', u'C')
 
+    def test_redirect_map(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'.redirect C', u'B')
+        self.assertEqual(u'C', PageRedirect.resolve(u'A'))
+        self.assertEqual(u'C', PageRedirect.resolve(u'B'))
+        self.assertEqual(u'D', PageRedirect.resolve(u'D'))
+
+        self.update_page(u'Hello', u'B')
+        self.assertEqual(u'B', PageRedirect.resolve(u'A'))
+        self.assertEqual(u'B', WikiPage.get_by_title(u'A', follow_redirect=True).title)
+
+    def test_circular_redirect_through_other_pages(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'.redirect C', u'B')
+        self.assertRaises(ValueError, self.update_page, u'.redirect B', u'C')
+        self.assertRaises(ValueError, self.update_page, u'.redirect A', u'B')
+
+    def test_stored_circular_redirect_is_left_unresolved(self):
+        self.update_page(u'Hello', u'C')
+        PageRedirect(source=u'A', target=u'B').save()
+        PageRedirect(source=u'B', target=u'A').save()
+        PageRedirect(source=u'D', target=u'C').save()
+        caching.del_redirects()
+
+        self.assertEqual(u'A', WikiPage.get_by_title(u'A', follow_redirect=True).title)
+        self.assertEqual(u'B', PageRedirect.resolve(u'B'))
+        self.assertEqual(u'C', WikiPage.get_by_title(u'D', follow_redirect=True).title)
+
+    def test_follow_redirect_does_not_load_redirecting_pages(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'.redirect C', u'B')
+        self.update_page(u'Hello', u'C')
+        with WikiPage.identity_map():
+            WikiPage.get_by_title(u'A', follow_redirect=True)
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(u'C', WikiPage.get_by_title(u'A', follow_redirect=True).title)
+                self.assertEqual(u'C', WikiPage.get_by_title(u'B', follow_redirect=True).title)
+            self.assertEqual(0, len(ctx))
+
+    def test_redirects_are_cached_per_title(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'.redirect C', u'B')
+        self.assertEqual({u'A': u'C', u'D': u'D'}, PageRedirect.resolve_many([u'A', u'D']))
+        self.assertEqual({u'A': u'C', u'B': u'C', u'D': u'D'}, caching.get_redirects([u'A', u'B', u'D']))
+
+        self.update_page(u'.redirect D', u'B')
+        self.assertEqual({}, caching.get_redirects([u'A', u'D']))
+        self.assertEqual(u'D', PageRedirect.resolve(u'A'))
+
+    def test_rebuild(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'.redirect C', u'B')
+        PageRedirect.objects.all().delete()
+        self.assertEqual([], PageRedirect.rebuild())
+        self.assertEqual(u'C', PageRedirect.resolve(u'A'))
+
+    def test_rebuild_rejects_circular_redirect(self):
+        self.update_page(u'.redirect B', u'A')
+        self.update_page(u'Hello', u'B')
+        # stored before circular redirections were rejected
+        WikiPage.objects.filter(title=u'B').update(body=u'.redirect A')
+        RenderedPage.objects.all().delete()
+        cache.clear()
+
+        circular = PageRedirect.rebuild()
+        self.assertEqual(1, len(circular))
+        self.assertEqual(1, PageRedirect.objects.count())
+        self.assertFalse(PageRedirect.objects.filter(source=circular[0]).exists())
+
 
 class LinkTest(WikiTestCase):
     def setUp(self):
@@ -503,7 +629,54 @@ class LinkTest(WikiTestCase):
         self.update_page(u'[[A]]', u'C')
 
         scoretable = WikiPage.get_by_title(u'A').link_scoretable
-        self.assertEqual([u'C', u'B', u'D'], scoretable.keys())
+        self.assertEqual([u'B', u'C', u'D'], scoretable.keys())
+
+    def test_link_scoretable_is_materialized(self):
+        self.update_page(u'[[B]]', u'A')
+        WikiPage.get_by_title(u'A').link_scoretable
+        self.assertEqual([[Title.objects.get(title=u'B').id, 1.0]], LinkScoreTable.objects.get(title=u'A').scores)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual({u'B': 1.0}, WikiPage.get_by_title(u'A').link_scoretable)
+        self.assertEqual(3, len(ctx))
+
+    def test_search(self):
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.update_page(u'[[C]], [[D]]', u'E')
+        self.assertEqual([u'C', u'B', u'D'], WikiPage.search(u'+A +E').keys())
+        self.assertEqual([u'D', u'C', u'B'], WikiPage.search(u'+E -A').keys())
+        self.assertEqual([u'C'], WikiPage.search(u'+A +E', 1).keys())
+
+    def test_search_does_not_store_nonexistent_pages(self):
+        self.update_page(u'[[B]]', u'A')
+        WikiPage.get_by_title(u'A').link_scoretable
+        titles = Title.objects.count()
+        self.assertEqual({}, WikiPage.search(u'+X -Y'))
+        self.assertEqual([u'B'], WikiPage.search(u'+A +X').keys())
+        self.assertEqual(titles, Title.objects.count())
+        self.assertFalse(LinkScoreTable.objects.filter(title__in=[u'X', u'Y']).exists())
+
+    def test_reading_scoretable_does_not_create_title_ids(self):
+        self.update_page(u'[[B]]', u'A')
+        Title.objects.filter(title=u'B').delete()
+        self.assertEqual({}, WikiPage.get_by_title(u'A').link_scoretable)
+        self.assertFalse(Title.objects.filter(title=u'B').exists())
+
+    def test_link_scoretable_is_updated_with_links(self):
+        a = self.update_page(u'[[B]]', u'A')
+        WikiPage.get_by_title(u'B').link_scoretable
+        a.link_scoretable
+
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.assertEqual({u'B': 0.5, u'C': 0.5}, WikiPage.get_by_title(u'A').link_scoretable)
+
+        self.update_page(u'[[B]]', u'D')
+        self.assertEqual({u'A': 0.5, u'D': 0.5}, WikiPage.get_by_title(u'B').link_scoretable)
+
+        a = WikiPage.get_by_title(u'A')
+        a.related_links = {u'D': 0.1}
+        a.save()
+        self.assertEqual(0.1, WikiPage.get_by_title(u'A').link_scoretable[u'D'])
 
     def test_link_in_yaml_schema_block(self):
         page = self.update_page(u'.schema Book\n    #!yaml/schema\n    author: Richard Dawkins\n', u'A')
@@ -521,6 +694,190 @@ class LinkTest(WikiTestCase):
         self.assertEqual({u'Book/datePublished': [u'A', u'B']}, year.inlinks)
 
 
+class LinkTableTest(WikiTestCase):
+    def test_links_are_stored_as_rows(self):
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.assertEqual({(u'B', u'Article/relatedTo'), (u'C', u'Article/relatedTo')},
+                         set(WikiPageLink.objects.filter(source=u'A').values_list('target', 'rel')))
+
+    def test_adding_link_does_not_rewrite_other_links(self):
+        titles = [u'T%d' % i for i in range(20)]
+        self.update_page(u', '.join(u'[[%s]]' % t for t in titles), u'A')
+        ids = set(WikiPageLink.objects.filter(source=u'A').values_list('id', flat=True))
+
+        self.update_page(u', '.join(u'[[%s]]' % t for t in titles + [u'New']), u'A')
+        links = WikiPageLink.objects.filter(source=u'A')
+        self.assertEqual(21, links.count())
+        self.assertTrue(ids.issubset(set(links.values_list('id', flat=True))))
+
+    def test_restricted_page_links_are_not_public(self):
+        self.update_page(u'Hello', u'B')
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'.read 0hoo@0hoo.com\n[[B]]', u'A')
+        self.assertFalse(WikiPageLink.objects.get(source=u'A', target=u'B').public)
+        self.assertEqual({}, WikiPage.get_by_title(u'B').inlinks)
+
+        self.update_page(u'[[B]]', u'A')
+        self.assertEqual({u'Article/relatedTo': [u'A']}, WikiPage.get_by_title(u'B').inlinks)
+
+    def test_move_inlinks(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'[[B]], [[C]]', u'D')
+        self.assertEqual({u'A', u'D'}, WikiPageLink.move_inlinks(u'B', u'C'))
+        self.assertEqual(0, WikiPageLink.objects.filter(target=u'B').count())
+        self.assertEqual({u'Article/relatedTo': [u'A', u'D']}, WikiPageLink.inlinks_of(u'C'))
+
+    def test_migrate_legacy_columns(self):
+        self._create_legacy_table()
+        call_command('migrate_links', stdout=StringIO())
+        self.assertEqual([(u'A', u'B')], list(WikiPageLink.objects.values_list('source', 'target')))
+        self.update_page(u'Hello', u'C')
+
+    def test_rebuild_table_without_legacy_columns(self):
+        # for databases which cannot drop columns
+        self._create_legacy_table()
+        command = migrate_links.Command()
+        command.stdout = StringIO()
+        command.rebuild_table()
+        self.update_page(u'Hello', u'C')
+        self.assertEqual(u'[[B]]', WikiPage.get_by_title(u'A').body)
+        columns = [c.name for c in connection.introspection.get_table_description(connection.cursor(),
+                                                                                   WikiPage._meta.db_table)]
+        self.assertNotIn('_outlinks', columns)
+
+    def _create_legacy_table(self):
+        qn = connection.ops.quote_name
+        table = qn(WikiPage._meta.db_table)
+        create, _ = connection.creation.sql_create_model(WikiPage, no_style())
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE %s' % table)
+        cursor.execute(create[0].rstrip(';').rstrip()[:-1] + ', "_inlinks" text NOT NULL, "_outlinks" text NOT NULL)')
+        cursor.execute('INSERT INTO %s (title, body, itemtype_path, description, comment, acl_read, acl_write, '
+                       'revision, _related_links, _inlinks, _outlinks) '
+                       'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)' % table,
+                       [u'A', u'[[B]]', u'Thing/CreativeWork/Article/', u'', u'', u'', u'', 1, u'{}', u'{}',
+                        u'{"Article/relatedTo": ["B"]}'])
+
+
+class LinkJobTest(WikiTestCase):
+    def setUp(self):
+        super(LinkJobTest, self).setUp()
+        wiki_settings.ASYNC_LINK_PROPAGATION = True
+        cache.clear()
+
+    def tearDown(self):
+        wiki_settings.ASYNC_LINK_PROPAGATION = False
+        super(LinkJobTest, self).tearDown()
+
+    def test_target_pages_are_updated_by_job(self):
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.assertEqual(0, WikiPage.objects.filter(title__in=[u'B', u'C']).count())
+        self.assertEqual({u'Article/relatedTo': [u'A']}, WikiPage.get_by_title(u'B').inlinks)
+
+        self.assertEqual(1, LinkJob.process())
+        self.assertEqual(2, WikiPage.objects.filter(title__in=[u'B', u'C']).count())
+        self.assertEqual(0, LinkJob.objects.count())
+
+    def test_save_does_not_depend_on_number_of_links(self):
+        self.update_page(u'[[B]]', u'A')
+        with CaptureQueriesContext(connection) as one:
+            self.update_page(u'[[B]], [[C]]', u'A')
+        with CaptureQueriesContext(connection) as many:
+            self.update_page(u'[[B]], [[C]], ' + u', '.join(u'[[T%d]]' % i for i in range(30)), u'A')
+        self.assertEqual(len(one), len(many))
+
+    def test_job_is_idempotent(self):
+        self.update_page(u'[[B]]', u'A')
+        job = LinkJob.objects.get()
+        job.run()
+        job.run()
+        self.assertEqual(1, WikiPage.objects.filter(title=u'B').count())
+
+    def test_stale_job_does_not_create_unlinked_page(self):
+        self.update_page(u'[[B]]', u'A')
+        job = LinkJob.objects.get()
+        self.update_page(u'Hello', u'A')
+
+        job.run()
+        self.assertEqual(0, WikiPage.objects.filter(title=u'B').count())
+
+    def test_placeholders_are_removed_by_job_of_non_admin(self):
+        self.update_page(u'[[B]], [[C]]', u'A')
+        self.assertEqual(1, LinkJob.process())
+        self.assertFalse(self.get_cur_user().is_superuser)
+
+        self.update_page(u'Hello', u'A')
+        self.assertEqual(1, LinkJob.process())
+        self.assertEqual(0, LinkJob.objects.count())
+        self.assertEqual({}, WikiPage.get_by_title(u'B').inlinks)
+        self.assertEqual({}, WikiPage.get_by_title(u'C').inlinks)
+
+    def test_failed_job_is_retried(self):
+        job = LinkJob.enqueue(u'A', None, set(), {(u'B', u'Article/relatedTo')})
+        original = WikiPage._update_inlinks
+
+        def fail(page, added, removed):
+            raise RuntimeError('fail')
+        WikiPage._update_inlinks = fail
+        try:
+            self.assertEqual(0, LinkJob.process())
+        finally:
+            WikiPage._update_inlinks = original
+
+        job = LinkJob.objects.get(id=job.id)
+        self.assertEqual(1, job.attempts)
+        self.assertIn('fail', job.last_error)
+        self.assertEqual(1, LinkJob.process())
+
+
+class PageLinkStatTest(WikiTestCase):
+    def test_orphans(self):
+        self.update_page(u'Hello', u'A')
+        self.update_page(u'[[A]]', u'B')
+        self.assertEqual([u'B'], PageLinkStat.orphans())
+
+        self.update_page(u'Hello', u'B')
+        self.assertEqual([u'A', u'B'], PageLinkStat.orphans())
+        self.assertEqual([u'A', u'B'], [p.title for p in WikiPage.get_orphans(None)])
+
+    def test_wanted(self):
+        self.update_page(u'[[C]], [[D]]', u'A')
+        self.update_page(u'[[C]]', u'B')
+        self.assertEqual([(u'C', 2), (u'D', 1)], PageLinkStat.wanted())
+
+        self.update_page(u'Hello', u'C')
+        self.assertEqual([(u'D', 1)], PageLinkStat.wanted())
+        self.update_page(u'Hello', u'D')
+        self.assertEqual([], PageLinkStat.wanted())
+        self.assertEqual([u'A', u'B'], PageLinkStat.orphans())
+
+    def test_paging(self):
+        for i in range(5):
+            self.update_page(u'Hello', u'P%d' % i)
+        self.assertEqual([u'P2', u'P3'], PageLinkStat.orphans(1, 2))
+        self.assertEqual([u'P4'], PageLinkStat.orphans(2, 2))
+
+    def test_restricted_links(self):
+        self.update_page(u'Hello', u'A')
+        self.update_page(u'.read 0hoo@0hoo.com\n[[A]]', u'B')
+        self.assertEqual([u'A', u'B'], PageLinkStat.orphans())
+
+    def test_redirect(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'Hello', u'C')
+        self.update_page(u'.redirect C', u'B')
+        self.assertEqual([u'A', u'B'], PageLinkStat.orphans())
+        self.assertEqual([], PageLinkStat.wanted())
+
+    def test_rebuild(self):
+        self.update_page(u'[[C]]', u'A')
+        self.update_page(u'Hello', u'B')
+        expected = (PageLinkStat.orphans(), PageLinkStat.wanted())
+        PageLinkStat.objects.all().delete()
+        PageLinkStat.rebuild()
+        self.assertEqual(expected, (PageLinkStat.orphans(), PageLinkStat.wanted()))
+
+
 class HashbangTest(WikiTestCase):
     def setUp(self):
         super(HashbangTest, self).setUp()
@@ -541,6 +898,265 @@ class HashbangTest(WikiTestCase):
         page = self.update_page(u'*   Hello ``#!dot/s;There``!')
         self.assertEqual(['dot/s'], page.hashbangs)
 
+    def test_mathjax(self):
+        self.assertEqual(['mathjax'], self.update_page(u'Hello \\(x^2\\)').hashbangs)
+        self.assertEqual(['mathjax'], self.update_page(u'$$x$$').hashbangs)
+        self.assertEqual([], self.update_page(u'$$ only').hashbangs)
+        self.assertEqual([], self.update_page(u'Hello \\(\\)').hashbangs)
+
+    def test_cached_with_rendered_body(self):
+        page = self.update_page(u'    #!python\n    print 1', u'Hello')
+        caching.del_hashbangs(u'Hello')
+        caching.del_rendered_body(u'Hello')
+
+        page.rendered_body
+        self.assertEqual(['python'], caching.get_hashbangs(u'Hello'))
+
+
+class BlockRenderingTest(WikiTestCase):
+    def setUp(self):
+        super(BlockRenderingTest, self).setUp()
+        cache.clear()
+        self.body = u'Hello [[A]]\n\n# One\n* a\n* b\n\n# Two\n    code\n\n## Three\nLast'
+
+    def uncached_blocks(self, body):
+        blocks = re.split(PageOperationMixin.re_block_boundary, body)
+        cached = caching.get_rendered_blocks([PageOperationMixin.block_key(b) for b in blocks])
+        return [b for b in blocks if PageOperationMixin.block_key(b) not in cached]
+
+    def test_same_as_whole_document(self):
+        expected = PageOperationMixin.sanitize_html(u'<div>%s</div>' % md.convert(self.body))
+        self.assertEqual(expected, PageOperationMixin.render_markdown(self.body))
+        self.assertEqual(expected, PageOperationMixin.render_markdown(self.body))
+
+    def test_only_changed_block_is_rendered(self):
+        PageOperationMixin.render_markdown(self.body)
+        self.assertEqual([], self.uncached_blocks(self.body))
+
+        changed = self.body.replace(u'* b', u'* c')
+        self.assertEqual([u'# One\n* a\n* c'], self.uncached_blocks(changed))
+
+    def test_blocks_are_rendered_again_after_upgrade(self):
+        PageOperationMixin.render_markdown(self.body)
+        version = wiki_settings.VERSION
+        wiki_settings.VERSION = version + u'_new'
+        try:
+            self.assertEqual(re.split(PageOperationMixin.re_block_boundary, self.body),
+                             self.uncached_blocks(self.body))
+        finally:
+            wiki_settings.VERSION = version
+
+    def test_unsplittable_document(self):
+        body = u'[x][1]\n\n# One\n\n[1]: http://x.com'
+        expected = PageOperationMixin.sanitize_html(u'<div>%s</div>' % md.convert(body))
+        self.assertEqual(expected, PageOperationMixin.render_markdown(body))
+
+    def test_validation_render_is_reused_on_save(self):
+        self.update_page(u'Hello [[A]]', u'B')
+
+        rendered = []
+        render_block = PageOperationMixin._render_block.im_func
+
+        def counting_render_block(cls, text):
+            rendered.append(text)
+            return render_block(cls, text)
+        PageOperationMixin._render_block = classmethod(counting_render_block)
+        try:
+            page = self.update_page(u'.pub\n' + self.body, u'A')
+        finally:
+            PageOperationMixin._render_block = classmethod(render_block)
+
+        self.assertEqual(len(set(rendered)), len(rendered))
+        self.assertEqual(page.rendered_body, caching.get_rendered_body(u'A'))
+        self.assertEqual(page.revision, RenderedPage.objects.get(title=u'A').revision)
+
+
+class BatchedCacheTest(WikiTestCase):
+    def test_rendered_blocks(self):
+        caching.set_rendered_blocks({'a': u'<p>A</p>', 'b': u''})
+        self.assertEqual({'a': u'<p>A</p>', 'b': u''}, caching.get_rendered_blocks(['a', 'b', 'c']))
+
+    def test_del_rendered(self):
+        caching.set_rendered(u'\ud55c A', u'<p>A</p>', [])
+        caching.set_rendered(u'B', u'<p>B</p>', ['python'])
+        self.assertEqual(['python'], caching.get_hashbangs(u'B'))
+
+        caching.del_rendered([u'\ud55c A', u'B'])
+        self.assertIsNone(caching.get_rendered_body(u'\ud55c A'))
+        self.assertIsNone(caching.get_hashbangs(u'\ud55c A'))
+        self.assertIsNone(caching.get_rendered_body(u'B'))
+        self.assertIsNone(caching.get_hashbangs(u'B'))
+
+    def test_invalidate_linked_pages(self):
+        self.update_page(u'Hello', u'A').rendered_body
+        self.update_page(u'Hello', u'B').rendered_body
+        self.update_page(u'[[A]] [[B]]', u'C')
+        self.assertIsNone(caching.get_rendered_body(u'A'))
+        self.assertIsNone(caching.get_rendered_body(u'B'))
+
+
+class CacheNamespaceTest(WikiTestCase):
+    def test_del_titles_of_all_users(self):
+        caching.set_titles(u'a@x.com', set([u'A']))
+        caching.set_titles(u'None', set([u'B']))
+        caching.del_titles()
+        self.assertIsNone(caching.get_titles(u'a@x.com'))
+        self.assertIsNone(caching.get_titles(u'None'))
+
+    def test_other_namespaces_are_not_affected(self):
+        caching.set_config({'a': 1})
+        caching.set_rendered(u'A', u'<p>A</p>', [])
+        caching.del_titles()
+        caching.del_schema()
+        self.assertEqual({'a': 1}, caching.get_config())
+        self.assertEqual(u'<p>A</p>', caching.get_rendered_body(u'A'))
+
+    def test_evicted_generation(self):
+        caching.set_config({'a': 1})
+        cache.delete('generation:model:config')
+        self.assertIsNone(caching.get_config())
+
+    def test_wikiquery_reflects_update(self):
+        self.update_page(u'.schema Book', u'A')
+        self.assertEqual([u'A'], WikiPage.wikiquery_titles(u'schema:"Book"'))
+        self.update_page(u'.schema Book', u'B')
+        self.assertEqual([u'A', u'B'], WikiPage.wikiquery_titles(u'schema:"Book"'))
+
+    def test_single_round_trip_for_namespaced_get(self):
+        class CountingCache(object):
+            def __init__(self):
+                self.calls = 0
+
+            def __getattr__(self, name):
+                self.calls += 1
+                return getattr(cache, name)
+
+        caching.set_config({'a': 1})
+        counting = caching.cache = CountingCache()
+        try:
+            self.assertEqual({'a': 1}, caching.get_config())
+        finally:
+            caching.cache = cache
+        self.assertEqual(1, counting.calls)
+
+
+class IdentityMapTest(WikiTestCase):
+    def test_same_instance_within_map(self):
+        self.update_page(u'Hello', u'A')
+        self.assertIsNot(WikiPage.get_by_title(u'A'), WikiPage.get_by_title(u'A'))
+        with WikiPage.identity_map():
+            self.assertIs(WikiPage.get_by_title(u'A'), WikiPage.get_by_title(u'A'))
+            self.assertIs(WikiPage.get_by_title(u'New'), WikiPage.get_by_title(u'New'))
+
+    def test_nested_map(self):
+        with WikiPage.identity_map():
+            page = WikiPage.get_by_title(u'A')
+            with WikiPage.identity_map():
+                self.assertIs(page, WikiPage.get_by_title(u'A'))
+            self.assertIs(page, WikiPage.get_by_title(u'A'))
+        self.assertIsNot(page, WikiPage.get_by_title(u'A'))
+
+    def test_prefetch(self):
+        self.update_page(u'Hello', u'A')
+        self.update_page(u'Hello', u'B')
+        with WikiPage.identity_map():
+            with CaptureQueriesContext(connection) as queries:
+                WikiPage.prefetch([u'A', u'B', u'C'])
+            self.assertEqual(1, len(queries))
+
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(1, WikiPage.get_by_title(u'A').revision)
+                self.assertEqual(0, WikiPage.get_by_title(u'C').revision)
+            self.assertEqual(0, len(queries))
+
+    def test_updating_page_is_shared(self):
+        self.update_page(u'[[B]]', u'A')
+        self.update_page(u'[[A]]', u'B')
+        with WikiPage.identity_map():
+            page = WikiPage.get_by_title(u'A')
+            page.update_content(u'[[B]] [[C]]', page.revision, user=self.get_cur_user())
+            self.assertIs(page, WikiPage.get_by_title(u'A'))
+        self.assertEqual({u'Article/relatedTo': [u'B', u'C']}, WikiPage.get_by_title(u'A').outlinks)
+        self.assertEqual({u'Article/relatedTo': [u'B']}, WikiPage.get_by_title(u'A').inlinks)
+
+
+class MarkdownPoolTest(WikiTestCase):
+    def test_state_is_reset_after_convert(self):
+        pool = MarkdownPool(1)
+        pool.convert(u'[1]: http://x.com')
+        self.assertEqual(u'<p>[foo][1]</p>', pool.convert(u'[foo][1]'))
+
+    def test_convert_when_pool_is_exhausted(self):
+        pool = MarkdownPool(0)
+        self.assertEqual(u'<p><em>a</em></p>', pool.convert(u'*a*'))
+
+    def test_concurrent_convert(self):
+        pool = MarkdownPool(2)
+        body = u'# A\n\n* a\n* [[b]]\n\nsec::---\n\nc'
+        expected = pool.convert(body)
+        results = []
+
+        def convert():
+            for _ in range(20):
+                results.append(pool.convert(body))
+        threads = [threading.Thread(target=convert) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([expected] * 80, results)
+
+
+class RenderedPageStoreTest(WikiTestCase):
+    def test_render_is_stored(self):
+        page = self.update_page(u'Hello [[There]]', u'Hello')
+        page.rendered_body
+        stored = RenderedPage.objects.get(title=u'Hello')
+        self.assertEqual(page.revision, stored.revision)
+        self.assertEqual(page.rendered_body, stored.body)
+
+    def test_stored_render_is_used_when_cache_is_empty(self):
+        page = self.update_page(u'Hello', u'Hello')
+        page.rendered_body
+        RenderedPage.objects.filter(title=u'Hello').update(body=u'<p>Stored</p>')
+
+        cache.clear()
+        self.assertEqual(u'<p>Stored</p>', WikiPage.get_by_title(u'Hello').rendered_body)
+
+    def test_stale_render_is_ignored(self):
+        page = self.update_page(u'Hello', u'Hello')
+        page.rendered_body
+        RenderedPage.objects.filter(title=u'Hello').update(body=u'<p>Stored</p>', version=u'old')
+
+        cache.clear()
+        self.assertNotEqual(u'<p>Stored</p>', WikiPage.get_by_title(u'Hello').rendered_body)
+
+    def test_store_same_page_twice(self):
+        page = self.update_page(u'Hello', u'Hello')
+        RenderedPage.store(page, u'<p>First</p>', [], {}, {})
+        RenderedPage.store(page, u'<p>Second</p>', [], {}, {})
+
+        self.assertEqual(1, RenderedPage.objects.filter(title=u'Hello').count())
+        self.assertEqual(u'<p>Second</p>', RenderedPage.objects.get(title=u'Hello').body)
+
+    def test_delete_page_with_stored_render(self):
+        page = self.update_page(u'.schema Book\n[[author::X]]', u'A')
+        page.rendered_body
+        cache.clear()
+
+        user = self.login('0hooadmin', '0hooadmin', page, is_admin=True)
+        page.delete(user)
+
+        self.assertEqual(0, WikiPageLink.objects.filter(source=u'A').count())
+        self.assertEqual([], PageLinkStat.wanted())
+        self.assertEqual(0, RenderedPage.objects.filter(title=u'A').count())
+
+    def test_invalidate_when_inlinks_are_changed(self):
+        self.update_page(u'Hi', u'There').rendered_body
+        self.update_page(u'Hello [[There]]', u'Hello')
+        self.assertEqual(0, RenderedPage.objects.filter(title=u'There').count())
+
 
 class TitleGroupingTest(WikiTestCase):
     def test_alphabet(self):
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from .. import schema
 from .. import caching
 from ..page_operation_mixin import PageOperationMixin
@@ -81,6 +83,7 @@ class CustomTypeAndPropertyTest(TestCase):
 
     def tearDown(self):
         schema.SCHEMA_TO_LOAD = schema.SCHEMA_TO_LOAD[:-1]
+        caching.del_schema()
         super(CustomTypeAndPropertyTest, self).tearDown()
 
     def test_inheritance_relationship(self):
@@ -129,6 +132,7 @@ class SimpleCustomTypeAndPropertyTest(TestCase):
 
     def tearDown(self):
         schema.SCHEMA_TO_LOAD = schema.SCHEMA_TO_LOAD[:-1]
+        caching.del_schema()
         super(SimpleCustomTypeAndPropertyTest, self).tearDown()
 
     def test_populate_omitted_item_fields(self):
@@ -183,6 +187,7 @@ class EnumerationTest(TestCase):
 
     def tearDown(self):
         schema.SCHEMA_TO_LOAD = schema.SCHEMA_TO_LOAD[:-1]
+        caching.del_schema()
         super(EnumerationTest, self).tearDown()
 
     def test_enum(self):
@@ -215,6 +220,7 @@ class CustomCardinalityTest(TestCase):
 
     def tearDown(self):
         schema.SCHEMA_TO_LOAD = schema.SCHEMA_TO_LOAD[:-1]
+        caching.del_schema()
         super(CustomCardinalityTest, self).tearDown()
 
     def test_props_gt_cardinality(self):
@@ -380,6 +386,29 @@ class SchemaIndexTest(WikiTestCase):
         self.update_page(u'longDescription::---\n\nHello there', u'Hello')
         self.assertFalse(SchemaDataIndex.has_match(u'Hello', u'longDescription', u'Hello there'))
 
+    def test_bulk_update(self):
+        old_data = {u'keywords': [u'k%d' % i for i in range(250)], u'author': u'AK'}
+        new_data = {u'keywords': [u'k%d' % i for i in range(100, 350)], u'author': u'AK'}
+        SchemaDataIndex.update_index(u'Hello', old_data)
+        SchemaDataIndex.update_index(u'Hello', new_data)
+
+        self.assertFalse(SchemaDataIndex.has_match(u'Hello', u'keywords', u'k99'))
+        self.assertTrue(SchemaDataIndex.has_match(u'Hello', u'keywords', u'k100'))
+        self.assertTrue(SchemaDataIndex.has_match(u'Hello', u'keywords', u'k349'))
+        self.assertTrue(SchemaDataIndex.has_match(u'Hello', u'author', u'AK'))
+        self.assertEqual(251, SchemaDataIndex.query_by_title(u'Hello').count())
+
+    def test_number_of_queries_does_not_depend_on_number_of_values(self):
+        def count_queries(n):
+            data = {u'keywords': [u'k%d' % i for i in range(n)]}
+            with CaptureQueriesContext(connection) as queries:
+                SchemaDataIndex.update_index(u'Hello', data)
+                SchemaDataIndex.update_index(u'Hello', {})
+                SchemaDataIndex.rebuild_index(u'Hello', data)
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(50))
+
 
 class TypeConversionTest(WikiTestCase):
     def test_unknown_itemtype(self):
@@ -534,6 +563,7 @@ class SchemaChangeTest(WikiTestCase):
 
     def tearDown(self):
         schema.SCHEMA_TO_LOAD = schema.SCHEMA_TO_LOAD[:-1]
+        caching.del_schema()
         super(SchemaChangeTest, self).tearDown()
 
     def test_change_schema_after_writing_and_try_to_read(self):
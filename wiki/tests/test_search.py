@@ -1,4 +1,5 @@
 from .. import search
+from .. import related
 from django.test import TestCase
 
 
@@ -75,4 +76,67 @@ class EvaluationTest(TestCase):
 
         expected = [u'C', u'B', u'D', u'A', u'E']
         actual = search.evaluate(positives, negatives).keys()
-        self.assertEqual(expected, actual)
\ No newline at end of file
+        self.assertEqual(expected, actual)
+
+    def test_top_k(self):
+        positives = {
+            u'Page 1': dict((u'T%02d' % i, 0.01 * i) for i in range(50)),
+        }
+        negatives = {
+            u'Page 2': dict((u'N%02d' % i, 0.01 * i) for i in range(1, 50)),
+        }
+
+        actual = search.evaluate(positives, negatives, 3)
+        self.assertEqual([u'T49', u'T48', u'T47', u'N47', u'N48', u'N49'], actual.keys())
+        self.assertAlmostEqual(-0.49 / 2, actual[u'N49'])
+
+    def test_top_k_ties(self):
+        positives = {u'A': {u'X': 0.1, u'Y': 0.1, u'Z': 0.1}}
+        self.assertEqual([u'X', u'Y'], search.evaluate(positives, {}, 2).keys())
+
+    def test_sorted_vectors(self):
+        positives = {u'A': [(u'B', 0.2), (u'C', 0.4)]}
+        negatives = {u'D': [(u'C', 0.2), (u'E', 0.1)]}
+        self.assertEqual([(u'B', 0.1), (u'C', 0.1), (u'E', -0.05)], search.evaluate(positives, negatives).items())
+
+
+class RelatedLinksTest(TestCase):
+    def setUp(self):
+        self.graph = related.LinkGraph([(u'A', u'B'), (u'B', u'C'), (u'C', u'D'), (u'E', u'C')])
+
+    def test_graph(self):
+        self.assertEqual(5, len(self.graph))
+        self.assertEqual({u'B', u'D', u'E'}, set(self.graph.neighbours(u'C')))
+        self.assertFalse(u'X' in self.graph)
+
+    def test_pagerank_scores_sum_to_one(self):
+        scores = related.personalized_pagerank(self.graph.adjacency, self.graph.index[u'A'], tolerance=1e-12, iterations=200)
+        self.assertAlmostEqual(1.0, sum(scores.values()))
+
+    def test_related_links_exclude_direct_links(self):
+        links = related.related_links(self.graph, u'A')
+        self.assertEqual({u'C', u'D', u'E'}, set(links.keys()))
+        self.assertTrue(links[u'C'] > links[u'D'])
+
+    def test_count(self):
+        self.assertEqual([u'C'], related.related_links(self.graph, u'A', count=1).keys())
+
+    def test_unknown_title(self):
+        self.assertEqual({}, related.related_links(self.graph, u'X'))
+
+    def test_push_related_links(self):
+        load = lambda titles: dict((t, self.graph.neighbours(t)) for t in titles)
+        links = related.push_related_links(load, u'A', epsilon=1e-6, max_pushes=10000)
+        self.assertEqual({u'C', u'D', u'E'}, set(links.keys()))
+        exact = related.related_links(self.graph, u'A', tolerance=1e-12, iterations=200)
+        for title, score in exact.items():
+            self.assertAlmostEqual(score, links[title], places=3)
+
+    def test_push_budget(self):
+        loaded = []
+
+        def load(titles):
+            loaded.extend(titles)
+            return dict((t, self.graph.neighbours(t)) for t in titles)
+        related.push_pagerank(load, u'A', epsilon=1e-9, max_pushes=3)
+        self.assertTrue(len(loaded) <= 4)
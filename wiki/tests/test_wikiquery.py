@@ -1,9 +1,20 @@
+from StringIO import StringIO
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
-from ..models import WikiPage
+from django.test.utils import CaptureQueriesContext
+from ..models import WikiPage, WikiqueryPlan
 from . import WikiTestCase
+from .. import caching
 from ..search import parse_wikiquery as p
 
 
+def wikiquery(q):
+    """Returns all results of q, or the result itself if there's only one"""
+    results = list(WikiPage.iter_wikiquery(q, WikiPage.wikiquery_titles(q)))
+    return results[0] if len(results) == 1 else results
+
+
 class ParserTest(TestCase):
     def test_simplist_expression(self):
         self.assertEqual((['name', 'A'], ['name'], []), p('name:"A" > name'))
@@ -23,6 +34,16 @@ class ParserTest(TestCase):
     def test_attr_expression(self):
         self.assertEqual((['name', 'A'], ['name', 'author'], []), p('name:"A" > name, author'))
 
+    def test_range_expression(self):
+        self.assertEqual((['year', '>', '2000'], ['name'], []), p('year:>"2000"'))
+        self.assertEqual((['year', '<', '2000'], ['name'], []), p('year:<"2000" > name'))
+        self.assertEqual((['year', '..', '1990', '2000'], ['name'], []), p('year:"1990".."2000"'))
+        self.assertEqual(([['name', '>', 'M'], '*', ['year', '..', '1', '2']], ['name'], []),
+                         p('>"M" * year:"1".."2"'))
+
+    def test_prefix_expression(self):
+        self.assertEqual((['name', 'A*'], ['name'], []), p('"A*"'))
+
 
 class EvaluationTest(WikiTestCase):
     def setUp(self):
@@ -33,49 +54,225 @@ class EvaluationTest(WikiTestCase):
         self.update_page(u'.schema Person', u'Douglas Hofstadter')
 
     def test_by_name(self):
-        self.assertEqual({u'name': u'GEB'}, WikiPage.wikiquery(u'"GEB"'))
+        self.assertEqual({u'name': u'GEB'}, wikiquery(u'"GEB"'))
 
     def test_by_schema(self):
         self.assertEqual([{u'name': u'GEB'}, {u'name': u'The Mind\'s I'}],
-                         WikiPage.wikiquery(u'schema:"Thing/CreativeWork/Book/"'))
+                         wikiquery(u'schema:"Thing/CreativeWork/Book/"'))
 
     def test_by_abbr_schema(self):
         self.assertEqual([{u'name': u'GEB'}, {u'name': u'The Mind\'s I'}],
-                         WikiPage.wikiquery(u'schema:"Book"'))
+                         wikiquery(u'schema:"Book"'))
 
     def test_by_attr(self):
         self.assertEqual([{u'name': u'GEB'}, {u'name': u'The Mind\'s I'}],
-                         WikiPage.wikiquery(u'author:"Douglas Hofstadter"'))
+                         wikiquery(u'author:"Douglas Hofstadter"'))
 
     def test_specifying_attr(self):
-        result = WikiPage.wikiquery(u'"GEB" > author')
+        result = wikiquery(u'"GEB" > author')
         self.assertEqual(u'Douglas Hofstadter', result['author'].pvalue)
 
-        result = WikiPage.wikiquery(u'"GEB" > name, author, datePublished')
+        result = wikiquery(u'"GEB" > name, author, datePublished')
         self.assertEqual(u'Douglas Hofstadter', result['author'].pvalue)
         self.assertEqual(u'GEB', result['name'].pvalue)
         self.assertEqual(u'1979', result['datePublished'].pvalue)
 
     def test_specifying_attr_order(self):
-        result = WikiPage.wikiquery(u'schema:"Book" > author, datePublished+')
+        result = wikiquery(u'schema:"Book" > author, datePublished+')
         self.assertEqual(u'1979', result[0]['datePublished'].pvalue)
         self.assertEqual(u'1982', result[1]['datePublished'].pvalue)
 
-        result = WikiPage.wikiquery(u'schema:"Book" > author, datePublished-')
+        result = wikiquery(u'schema:"Book" > author, datePublished-')
         self.assertEqual(u'1982', result[0]['datePublished'].pvalue)
         self.assertEqual(u'1979', result[1]['datePublished'].pvalue)
 
     def test_logical_operations(self):
         self.assertEqual([{u'name': u'GEB'}, {u'name': u'The Mind\'s I'}],
-                         WikiPage.wikiquery(u'"GEB" + "The Mind\'s I"'))
+                         wikiquery(u'"GEB" + "The Mind\'s I"'))
         self.assertEqual({u'name': u'The Mind\'s I'},
-                         WikiPage.wikiquery(u'schema:"Book" * author:"Douglas Hofstadter" * author:"Daniel Dennett"'))
+                         wikiquery(u'schema:"Book" * author:"Douglas Hofstadter" * author:"Daniel Dennett"'))
         self.assertEqual([{'name': u'GEB'}, {'name': u"The Mind's I"}],
-                         WikiPage.wikiquery(u'schema:"Book" + author:"Douglas Hofstadter" * author:"Daniel Dennett"'))
+                         wikiquery(u'schema:"Book" + author:"Douglas Hofstadter" * author:"Daniel Dennett"'))
 
     def test_complex(self):
-        result = WikiPage.wikiquery(u'schema:"Thing/CreativeWork/Book/" > name, author')
+        result = wikiquery(u'schema:"Thing/CreativeWork/Book/" > name, author')
         self.assertEqual(u'Douglas Hofstadter', result[0]['author'].pvalue)
         self.assertEqual(u'GEB', result[0]['name'].pvalue)
         self.assertEqual([u'Daniel Dennett', u'Douglas Hofstadter'], [v.pvalue for v in result[1]['author']])
-        self.assertEqual(u'The Mind\'s I', result[1]['name'].pvalue)
\ No newline at end of file
+        self.assertEqual(u'The Mind\'s I', result[1]['name'].pvalue)
+
+
+class PlanTest(WikiTestCase):
+    def setUp(self):
+        super(PlanTest, self).setUp()
+        self.update_page(u'.schema Book\n[[author::Daniel Dennett]] and [[author::Douglas Hofstadter]]', u'The Mind\'s I')
+        self.update_page(u'.schema Book\n[[author::Douglas Hofstadter]]', u'GEB')
+
+    def test_plan_is_cached(self):
+        q = u'schema:"Book" * author:"Douglas Hofstadter"'
+        self.assertTrue(WikiqueryPlan.get(q) is WikiqueryPlan.get(q))
+
+    def test_plan_is_recompiled_if_schema_is_changed(self):
+        q = u'schema:"Book" * author:"Douglas Hofstadter"'
+        plan = WikiqueryPlan.get(q)
+        caching.del_schema()
+        self.assertFalse(plan is WikiqueryPlan.get(q))
+
+    def test_plan_is_recompiled_after_rebuilding_schema_index(self):
+        q = u'schema:"Book" * author:"Douglas Hofstadter"'
+        plan = WikiqueryPlan.get(q)
+        call_command('rebuild_schema_index', stdout=StringIO())
+        self.assertFalse(plan is WikiqueryPlan.get(q))
+
+    def test_single_query_for_multiple_terms(self):
+        plan = WikiqueryPlan.get(u'schema:"Book" * (author:"Daniel Dennett" + author:"Douglas Hofstadter") * "GEB"')
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual({u'GEB'}, plan.titles())
+        self.assertEqual(1, len(ctx))
+
+
+class ProjectionTest(WikiTestCase):
+    def setUp(self):
+        super(ProjectionTest, self).setUp()
+        for i in range(10):
+            self.update_page(u'.schema Book\n[[author::Author %d]]\n[[datePublished::19%02d]]\n\nBody %d' % (i, i, i),
+                             u'Book %d' % i)
+        self.update_page(u'.schema Book\n[[author::Author A]] and [[author::Author B]]', u'Book X')
+
+    def test_values_from_index(self):
+        result = wikiquery(u'schema:"Book" > name, author, datePublished')
+        self.assertEqual(11, len(result))
+        self.assertEqual(u'Book 3', result[3]['name'].pvalue)
+        self.assertEqual(u'Author 3', result[3]['author'].pvalue)
+        self.assertEqual(1903, result[3]['datePublished'].year)
+        self.assertEqual([u'Author A', u'Author B'], [v.pvalue for v in result[10]['author']])
+        self.assertEqual(None, result[10]['datePublished'])
+
+    def test_pages_are_not_loaded_for_indexed_attrs(self):
+        WikiPage.get_titles()
+        with CaptureQueriesContext(connection) as ctx:
+            wikiquery(u'schema:"Book" > name, author')
+        self.assertFalse(any('wiki_wikipage"."body' in q['sql'] for q in ctx.captured_queries))
+
+    def test_non_indexed_attrs_from_page(self):
+        result = wikiquery(u'"Book 3" > name, longDescription')
+        self.assertEqual(u'Book 3', result['name'].pvalue)
+        self.assertTrue(result['longDescription'].pvalue.endswith(u'Body 3'))
+
+
+class PaginationTest(WikiTestCase):
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        for i in range(5):
+            self.update_page(u'.schema Book\n[[datePublished::19%02d]]' % i, u'Book %d' % i)
+
+    def test_titles_in_result_order(self):
+        self.assertEqual([u'Book 0', u'Book 1', u'Book 2', u'Book 3', u'Book 4'],
+                         WikiPage.wikiquery_titles(u'schema:"Book"'))
+        self.assertEqual([u'Book 4', u'Book 3', u'Book 2', u'Book 1', u'Book 0'],
+                         WikiPage.wikiquery_titles(u'schema:"Book" > name, datePublished-'))
+
+    def test_results_of_slice(self):
+        q = u'schema:"Book" > name, datePublished-'
+        titles = WikiPage.wikiquery_titles(q)
+        results = list(WikiPage.iter_wikiquery(q, titles[1:3]))
+        self.assertEqual([u'Book 3', u'Book 2'], [r['name'].pvalue for r in results])
+        self.assertEqual([u'1903', u'1902'], [r['datePublished'].pvalue for r in results])
+
+    def test_empty_or_negative_limit(self):
+        q = u'schema:"Book" > name, datePublished-'
+        self.assertEqual([], WikiPage.wikiquery_titles(q, limit=0))
+        self.assertEqual([], WikiPage.wikiquery_titles(q, limit=-1))
+        self.assertEqual([], WikiPage.wikiquery_titles(u'schema:"Book" > name, undefinedProperty', limit=-1))
+
+    def test_negative_offset_of_plan(self):
+        plan = WikiqueryPlan.get(u'schema:"Book" > name, datePublished-')
+        self.assertEqual([u'Book 4'], plan.sorted_titles(-2, 1))
+        self.assertEqual([], plan.sorted_titles(0, -1))
+        self.assertEqual(5, len(plan.sorted_titles(-2)))
+
+    def test_results_are_lazy(self):
+        q = u'schema:"Book" > name, datePublished'
+        titles = WikiPage.wikiquery_titles(q)
+        with CaptureQueriesContext(connection) as ctx:
+            results = WikiPage.iter_wikiquery(q, titles)
+        self.assertEqual(0, len(ctx))
+        self.assertEqual(u'Book 0', next(results)['name'].pvalue)
+
+
+class SortTest(WikiTestCase):
+    def setUp(self):
+        super(SortTest, self).setUp()
+        self.update_page(u'.schema Book\n[[numberOfPages::9]]\n[[datePublished::1979-03-01]]\n[[author::B]]', u'A')
+        self.update_page(u'.schema Book\n[[numberOfPages::100]]\n[[datePublished::1979]]\n[[author::A]]', u'B')
+        self.update_page(u'.schema Book\n[[numberOfPages::10]]\n[[datePublished::300 BCE]]\n[[author::A]]', u'C')
+        self.update_page(u'.schema Book', u'D')
+
+    def test_numbers(self):
+        self.assertEqual([u'A', u'C', u'B', u'D'], WikiPage.wikiquery_titles(u'schema:"Book" > numberOfPages+'))
+        self.assertEqual([u'B', u'C', u'A', u'D'], WikiPage.wikiquery_titles(u'schema:"Book" > numberOfPages-'))
+
+    def test_dates(self):
+        self.assertEqual([u'C', u'B', u'A', u'D'], WikiPage.wikiquery_titles(u'schema:"Book" > datePublished+'))
+
+    def test_multiple_criteria(self):
+        self.assertEqual([u'B', u'C', u'A', u'D'],
+                         WikiPage.wikiquery_titles(u'schema:"Book" > author+, numberOfPages-'))
+        self.assertEqual([u'C', u'B', u'A', u'D'],
+                         WikiPage.wikiquery_titles(u'schema:"Book" > author+, numberOfPages+'))
+
+    def test_top_k(self):
+        with CaptureQueriesContext(connection) as ctx:
+            titles = WikiPage.wikiquery_titles(u'schema:"Book" > numberOfPages-', limit=2)
+        self.assertEqual([u'B', u'C'], titles)
+        self.assertTrue(any('LIMIT 2' in q['sql'] for q in ctx.captured_queries))
+
+    def test_not_indexed_criteria(self):
+        self.update_page(u'.schema Book\nZ [[numberOfPages::1]]', u'E')
+        self.update_page(u'.schema Book\nY [[numberOfPages::2]]', u'F')
+        self.assertEqual([u'F', u'E'], WikiPage.wikiquery_titles(u'"E" + "F" > longDescription+, numberOfPages'))
+
+
+class RangeTest(WikiTestCase):
+    def setUp(self):
+        super(RangeTest, self).setUp()
+        self.update_page(u'.schema Book\n[[numberOfPages::9]]\n[[datePublished::1999-12-31]]', u'Apple')
+        self.update_page(u'.schema Book\n[[numberOfPages::100]]\n[[datePublished::2000]]', u'Banana')
+        self.update_page(u'.schema Book\n[[numberOfPages::10]]\n[[datePublished::2001-01]]', u'Apricot')
+        self.update_page(u'.schema Book\n[[datePublished::300 BCE]]', u'Cherry')
+
+    def titles(self, q):
+        return WikiPage.wikiquery_titles(q)
+
+    def test_numbers(self):
+        self.assertEqual([u'Apricot', u'Banana'], self.titles(u'numberOfPages:>"9"'))
+        self.assertEqual([u'Apple'], self.titles(u'numberOfPages:<"10"'))
+        self.assertEqual([u'Apple', u'Apricot'], self.titles(u'numberOfPages:"9".."10"'))
+
+    def test_dates(self):
+        self.assertEqual([u'Apricot'], self.titles(u'datePublished:>"2000"'))
+        self.assertEqual([u'Apple', u'Cherry'], self.titles(u'datePublished:<"2000"'))
+        self.assertEqual([u'Banana', u'Apricot'], self.titles(u'datePublished:"2000".."2001" > name, datePublished+'))
+        self.assertEqual([u'Cherry'], self.titles(u'datePublished:<"1 BCE"'))
+
+    def test_texts(self):
+        self.assertEqual([u'Banana', u'Cherry'], self.titles(u'>"Apricot"'))
+        self.assertEqual([u'Apricot', u'Banana'], self.titles(u'"Apricot".."Banana"'))
+
+    def test_prefix(self):
+        self.assertEqual([u'Apple', u'Apricot'], self.titles(u'"Ap*"'))
+        self.assertEqual([u'Apple', u'Apricot', u'Banana', u'Cherry'], self.titles(u'schema:"Thing/CreativeWork/*"'))
+        self.assertEqual([u'Apricot'], self.titles(u'"Ap*" * numberOfPages:>"9"'))
+        self.assertEqual([u'Apple', u'Apricot', u'Banana', u'Cherry'], self.titles(u'"*"'))
+
+    def test_prefix_followed_by_astral_character(self):
+        self.update_page(u'.schema Book', u'Ap\U0001F34E')
+        self.update_page(u'.schema Book', u'Aq')
+        self.assertEqual([u'Apple', u'Apricot', u'Ap\U0001F34E'], self.titles(u'"Ap*"'))
+        self.assertEqual([u'Ap\U0001F34E'], self.titles(u'"Ap\U0001F34E*"'))
+
+    def test_range_scan_in_single_query(self):
+        plan = WikiqueryPlan.get(u'"Ap*" * numberOfPages:"9".."10"')
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual({u'Apple', u'Apricot'}, plan.titles())
+        self.assertEqual(1, len(ctx))
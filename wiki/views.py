@@ -1,7 +1,7 @@
 from django.http import HttpResponse
 from resources import RedirectResource, PageResource, ChangeListResource, TitleIndexResource, TitleListResource, \
     UserPreferencesResource, PostListResource, SearchResultResource, RevisionListResource, RevisionResource, \
-    RelatedPagesResource, WikiqueryResource, SchemaResource
+    RelatedPagesResource, WikiqueryResource, SchemaResource, OrphanListResource, WantedListResource
 from representations import TemplateRepresentation
 from registration.backends.simple.views import RegistrationView
 from registration.forms import RegistrationFormUniqueEmail
@@ -60,6 +60,12 @@ def special(request, path):
         elif path == u'index':
             resource = TitleIndexResource(request)
             return resource.get(head)
+        elif path == u'orphans':
+            resource = OrphanListResource(request)
+            return resource.get(head)
+        elif path == u'wanted':
+            resource = WantedListResource(request)
+            return resource.get(head)
         elif path == u'posts':
             resource = PostListResource(request)
             return resource.get(head)
@@ -1,5 +1,20 @@
 VERSION = '0.0.1_20140407_1'
 
+# number of prebuilt markdown renderers shared by request threads
+MARKDOWN_POOL_SIZE = 4
+
+# update pages linked from an edited page in background. run "manage.py process_link_jobs" when enabled
+ASYNC_LINK_PROPAGATION = False
+
+# update related links of pages around an edited page when its links are changed
+INCREMENTAL_RELATED_LINKS = False
+# maximum number of approximate PageRank pushes spent on an edit
+RELATED_LINKS_PUSH_BUDGET = 1000
+
+# number of wikiquery results in a response when limit is not given, and the maximum of limit
+WIKIQUERY_PAGE_SIZE = 100
+WIKIQUERY_MAX_PAGE_SIZE = 1000
+
 DEFAULT_CONFIG = {
     'navigation': [
         {